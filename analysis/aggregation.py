@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+
+def category_codes(column):
+    # Integer codes (-1 where missing) and the labels they refer to
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy().astype(np.int64), column.cat.categories
+    return pd.factorize(column, sort=True)
+
+
+def category_codes_with_missing(column):
+    # As category_codes, but missing values get a code of their own, labelled
+    # NaN, so that they can be counted without filling in the column
+    codes, categories = category_codes(column)
+    codes[codes < 0] = len(categories)
+    return codes, pd.Index(list(categories) + [np.nan], dtype=object)
+
+
+def count_strata(df, stratifiers, outcome):
+    # Counts of every (category, outcome) pair for all the stratifiers in one
+    # np.bincount over offset integer codes, rather than one pd.crosstab per
+    # stratifier. Returns one frame per stratifier, shaped like
+    # pd.crosstab(df[v], df[outcome]) with a NaN row for missing values
+    outcome_codes, outcome_values = category_codes(df[outcome])
+    n_outcomes = len(outcome_values)
+
+    keys = []
+    labels = []
+    offset = 0
+    for v in stratifiers:
+        codes, categories = category_codes_with_missing(df[v])
+        observed = outcome_codes >= 0
+        keys.append((offset + codes[observed]) * n_outcomes + outcome_codes[observed])
+        labels.append(categories)
+        offset += len(categories)
+
+    counts = np.bincount(np.concatenate(keys), minlength=offset * n_outcomes)
+    counts = counts.reshape(offset, n_outcomes)
+
+    tables = []
+    start = 0
+    for v, categories in zip(stratifiers, labels):
+        tables.append(
+            pd.DataFrame(
+                counts[start : start + len(categories)],
+                index=pd.Index(categories, name=v),
+                columns=pd.Index(outcome_values, name=outcome),
+            )
+        )
+        start += len(categories)
+    return tables
+
+
+def sparse_columns(columns, n_rows):
+    # CSC matrix from the (rows, values) of each of its columns. It is built
+    # from its parts, so stored values that are zero stay in the matrix
+    from scipy import sparse
+
+    indices = [rows for rows, values in columns]
+    data = [values for rows, values in columns]
+    indptr = np.concatenate([[0], np.cumsum([len(rows) for rows in indices])])
+    return sparse.csc_matrix(
+        (np.concatenate(data), np.concatenate(indices), indptr),
+        shape=(n_rows, len(columns)),
+    )
+
+
+def code_matrix(df, codes):
+    # Match counts as a sparse patients x codes matrix, holding only the
+    # non-zero cells of the snomed_<code> columns, which are nearly all empty.
+    # The columns are still read densely into `df`, so this only spares the
+    # dense temporary arrays; the long-format code events are what keep
+    # memory down to the number of matches
+    columns = []
+    for code in codes:
+        counts = df[f"snomed_{code}"].to_numpy(dtype="float64", na_value=np.nan)
+        rows = np.flatnonzero(counts > 0)
+        columns.append((rows, counts[rows].astype(np.int64)))
+    return sparse_columns(columns, len(df))
+
+
+def date_matrix(df, columns):
+    # Dates as a sparse patients x columns matrix of days since the epoch,
+    # holding only the dates that are present. As with code_matrix, the dense
+    # columns are already in `df`
+    dates = []
+    for col in columns:
+        days = df[col].to_numpy(dtype="datetime64[D]")
+        rows = np.flatnonzero(~np.isnat(days))
+        dates.append((rows, days[rows].astype(np.int32)))
+    return sparse_columns(dates, len(df))
+
+
+def code_totals(df, codes):
+    # Total matches for each code, as the product of the sparse code matrix
+    # with a vector of ones
+    matches = code_matrix(df, codes)
+    totals = matches.T @ np.ones(matches.shape[0], dtype=np.int64)
+    return pd.Series(totals, index=codes, dtype="int64", name="Total records")
+
+
+def codes_table(codelists, totals):
+    table = codelists.join(totals)
+    table["%"] = (table["Total records"] / table["Total records"].sum()) * 100
+    return table
+
+
+def day_offsets(dates, origin):
+    # Days from `origin` to `dates` as int32, with missing dates below any bin
+    offsets = np.asarray(dates, dtype="datetime64[D]") - np.asarray(
+        origin, dtype="datetime64[D]"
+    )
+    missing = np.int32(np.iinfo(np.int32).min)
+    return np.where(np.isnat(offsets), missing, offsets.astype("int32"))
+
+
+def binned_counts(rows, offsets, n_rows, bins):
+    # Counts over right-closed bins like pd.cut for each row of the result,
+    # binned with a single searchsorted and counted with a single bincount
+    n_bins = len(bins) - 1
+    bin_index = np.searchsorted(bins, offsets, side="left") - 1
+    binned = (bin_index >= 0) & (bin_index < n_bins)
+    keys = (rows * n_bins + bin_index)[binned]
+    counts = np.bincount(keys, minlength=n_rows * n_bins)
+    return counts.reshape(n_rows, n_bins)
+
+
+def interval_counts(df, columns, origin, bins):
+    # Histogram of the days from `origin` to each of the date columns. Only
+    # the dates that are present are binned, taken from the sparse date
+    # matrix along with the column each one is in. Returns one row of bin
+    # counts per column
+    dates = date_matrix(df, columns)
+    origin = origin.to_numpy(dtype="datetime64[D]")[dates.indices]
+    offsets = day_offsets(dates.data.astype("datetime64[D]"), origin)
+    rows = np.repeat(np.arange(len(columns)), np.diff(dates.indptr))
+    return pd.DataFrame(
+        binned_counts(rows, offsets, len(columns), bins),
+        index=pd.Index(columns, name="column"),
+        columns=pd.IntervalIndex.from_breaks(bins, name="interval"),
+    )
+
+
+def event_interval_counts(events, codes, bins):
+    # As interval_counts, for long-format code events with a date and an
+    # origin each. Returns one row of bin counts per code
+    offsets = day_offsets(events["date"], events["first_covid_date"])
+    rows = pd.Index(codes).get_indexer(events["code"])
+    offsets[rows < 0] = np.iinfo(np.int32).min
+    return pd.DataFrame(
+        binned_counts(rows, offsets, len(codes), bins),
+        index=pd.Index(codes, name="code"),
+        columns=pd.IntervalIndex.from_breaks(bins, name="interval"),
+    )
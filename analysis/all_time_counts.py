@@ -1,140 +1,675 @@
+import argparse
+import io
 import os
-import numpy as np
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
 import pandas as pd
-import matplotlib.pyplot as plt
-from common_variables import demographic_variables, clinical_variables
+from aggregation import (
+    code_totals,
+    codes_table,
+    count_strata,
+    event_interval_counts,
+    interval_counts,
+)
+from disclosure import redact_small_numbers, round_to_base
+from outputs import csv_engines, flush, write_csv, write_text
+from practices import (
+    distribution,
+    grouped_distribution,
+    practice_counts,
+    practice_totals,
+    rates,
+    top_k,
+)
+from instrumentation import measure, measured_blocks, merge_reports, report_table
+from stage_cache import evict, read_entry, stage_key, write_entry
+from cohort import (
+    cohort_columns,
+    combined_codelists,
+    event_dtypes,
+    individual_code_dates,
+    individual_codes,
+    read_cohort,
+    read_events,
+    source_columns,
+    stratifiers,
+    write_shared,
+)
 
 pd.set_option("display.max_rows", 50)
 results_path = "output/practice_summ.txt"
-stratifiers = list(demographic_variables.keys())
-long_covid_codelists = [
-    "opensafely-nice-managing-the-long-term-effects-of-covid-19",
-    "opensafely-referral-and-signposting-for-long-covid",
-    "opensafely-assessment-instruments-and-outcome-measures-for-long-covid",
-    "user-alex-walker-post-viral-syndrome",
-]
-combined_codelists = [
-    pd.read_csv(f"codelists/{path}.csv", index_col="code")
-    for path in long_covid_codelists
-]
-combined_codelists = pd.concat(combined_codelists)
-individual_code_dates = [f"snomed_{c}_date" for c in combined_codelists.index]
-
-
-def crosstab(idx):
+weekly_variables = ["long_covid", "post_viral_fatigue"]
+interval_columns = ["first_long_covid_date"] + individual_code_dates
+# Intervals that also get their own CSV and a summary in practice_summ.txt
+reported_intervals = interval_columns[0:6]
+interval_bins = [-1000, -1, 0, 28, 56, 84, 112, 140, 168, 196, 1000]
+# Bins for the number of patients coded in each practice, and for its rate
+# per 100,000 registered patients
+practice_ranges = [-1, 0, 1, 2, 3, 4, 5, 10, 10000]
+practice_rate_ranges = [-1, 0, 50, 100, 200, 500, 1000, 2000, 100000]
+
+
+def crosstab(counts):
     cols = ["No long COVID", "Long COVID", "Rate per 100,000", "%"]
-    counts = pd.crosstab(idx, df["long_covid"], normalize=False, dropna=False)
-    rates = (
-        pd.crosstab(idx, df["long_covid"], normalize="index", dropna=False)[1] * 100000
-    ).round(1)
-    percentages = (
-        pd.crosstab(idx, df["long_covid"], normalize="columns", dropna=False)[1] * 100
-    ).round(1)
+    # Same arithmetic as pd.crosstab(normalize="index"/"columns"), but
+    # derived from counts so that they can be accumulated chunk by chunk
+    rates = (counts.div(counts.sum(axis=1), axis=0)[True] * 100000).round(1)
+    percentages = ((counts / counts.sum())[True] * 100).round(1)
     all_cols = pd.concat([counts, rates, percentages], axis=1)
     all_cols.columns = cols
     return all_cols
 
 
-def redact_small_numbers(df, column):
-    mask = df[column].isin([1, 2, 3, 4, 5])
-    df.loc[mask, :] = np.nan
-    return df
+## Partial counts for one block of the cohort
+def count_crosstabs(df):
+    return count_strata(df, stratifiers, "long_covid")
 
 
-def write_to_file(text_to_write, erase=False):
-    if erase and os.path.isfile(results_path):
-        os.remove(results_path)
-    with open(results_path, "a") as txt:
-        txt.writelines(f"{text_to_write}\n")
-        print(text_to_write)
-        txt.writelines("\n")
-        print("\n")
+def count_codes(df):
+    return code_totals(df, combined_codelists.index)
 
 
-def custom_round(x, base=5):
-    return int(base * round(float(x) / base))
+def count_by_practice(df):
+    return practice_counts(df, "long_covid", by="region")
 
 
-df = pd.read_csv(
-    "output/input_cohort.csv",
-    index_col="patient_id",
-    parse_dates=[
-        "first_long_covid_date",
-        "first_post_viral_fatigue_date",
-        "sgss_positive",
-        "primary_care_covid",
-        "hospital_covid",
-    ]
-    + individual_code_dates,
-)
+def weekly_partial(df, variable, since=None):
+    # Only weeks after `since` are counted, when earlier weeks are in the state
+    date_col = f"first_{variable}_date"
+    if since is None:
+        weekly_counts = df.loc[df[date_col].notna()]
+    else:
+        weekly_counts = df.loc[df[date_col] > since]
+    weekly_counts = weekly_counts.set_index(date_col)[variable]
+    return weekly_counts.resample("W").count()
 
-# Surface missing values
-df["ethnicity"] = df["ethnicity"].fillna(0)
-df["region"] = df["region"].fillna("AaMissing")
 
-# Find first COVID date
-first_covid_date = df[["sgss_positive", "primary_care_covid", "hospital_covid"]].min(
-    axis=1
-)
+def count_intervals(df, columns=interval_columns):
+    return interval_counts(df, columns, df["first_covid_date"], interval_bins)
 
-## Crosstabs
-crosstabs = [crosstab(df[v]) for v in stratifiers]
-all_together = pd.concat(
-    crosstabs, axis=0, keys=stratifiers + ["imdQ5_incorrect", "imdQ5_correct"], names=["Attribute", "Category"]
-)
-print(all_together)
-redact_small_numbers(all_together, "Long COVID").to_csv("output/counts_table.csv")
-
-## All long-covid codes table
-codes = [str(code) for code in combined_codelists.index]
-all_codes = df.copy()
-all_codes.columns = all_codes.columns.str.lstrip("snomed_")
-all_codes = all_codes[codes].sum().T
-all_codes = all_codes.rename("Total records")
-all_codes.index = all_codes.index.astype("int64")
-all_codes = combined_codelists.join(all_codes)
-all_codes["%"] = (all_codes["Total records"] / all_codes["Total records"].sum()) * 100
-redact_small_numbers(all_codes, "Total records").to_csv(
-    "output/all_long_covid_codes.csv"
-)
-print(all_codes.columns)
 
-## Descriptives by practice
-by_practice = (
-    df[["long_covid", "practice_id"]].groupby("practice_id").sum()["long_covid"]
-)
-write_to_file(f"Total patients coded: {by_practice.sum()}", erase=True)
-top_10_count = by_practice.sort_values().tail(10).sum()
-write_to_file(f"Patients coded in the highest 10 practices: {top_10_count}")
-practice_summ = by_practice.describe()
-write_to_file(f"Summary stats by practice:\n{practice_summ}")
-ranges = [-1, 0, 1, 2, 3, 4, 5, 10, 10000]
-practice_distribution = by_practice.groupby(pd.cut(by_practice, ranges)).count()
-write_to_file(f"Distribution of coding within practices: {practice_distribution}")
-practice_distribution.to_csv("output/practice_distribution.csv")
-
-
-def weekly_counts(variable):
-    weekly_counts = df.set_index(f"first_{variable}_date")[variable]
-    weekly_counts = weekly_counts.resample("W").count()
+## Partial counts for one block of the long-format code events
+def count_code_events(events):
+    totals = events.groupby("code")["count"].sum()
+    totals = totals.reindex(combined_codelists.index, fill_value=0)
+    return totals.astype("int64").rename("Total records")
+
+
+def count_event_intervals(events):
+    intervals = event_interval_counts(events, combined_codelists.index, interval_bins)
+    return intervals.set_axis(
+        pd.Index(individual_code_dates, name="column"), axis="index"
+    )
+
+
+## Running totals across blocks
+def add_counts(total, block):
+    if total is None:
+        return block
+    if isinstance(block, list):
+        return [add_counts(t, b) for t, b in zip(total, block)]
+    if all(a.equals(b) for a, b in zip(total.axes, block.axes)):
+        return total + block
+    combined = pd.concat([total, block])
+    if isinstance(combined, pd.DataFrame):
+        combined = combined.fillna(0).astype("int64")
+    levels = list(range(combined.index.nlevels)) if combined.index.nlevels > 1 else 0
+    return combined.groupby(level=levels, dropna=False).sum()
+
+
+## Outputs
+def parse_categories(counts):
+    # Convert the text categories as pd.read_csv would have done for the
+    # whole column, so the labels don't depend on how the cohort was split
+    counts = counts.loc[counts.sum(axis=1) > 0]
+    labels = pd.Series(counts.index).to_csv(index=False, header=["category"])
+    labels = pd.read_csv(io.StringIO(labels))["category"]
+
+    # Surface missing values
+    if counts.index.name == "ethnicity":
+        labels = labels.fillna(0)
+    if counts.index.name == "region":
+        labels = labels.fillna("AaMissing")
+
+    counts = counts.set_axis(pd.Index(labels, name=counts.index.name))
+    return counts.loc[counts.index.notna()].groupby(level=0).sum()
+
+
+def write_crosstabs(crosstabs, secondary_suppression=False):
+    crosstabs = [crosstab(parse_categories(counts)) for counts in crosstabs]
+    all_together = pd.concat(
+        crosstabs,
+        axis=0,
+        keys=stratifiers + ["imdQ5_incorrect", "imdQ5_correct"],
+        names=["Attribute", "Category"],
+    )
+    print(all_together)
+    all_together = redact_small_numbers(
+        all_together, "Long COVID", secondary=secondary_suppression, by="Attribute"
+    )
+    write_csv(all_together, "output/counts_table.csv")
+    return []
+
+
+def write_codes_table(totals, secondary_suppression=False, engine="pandas"):
+    all_codes = codes_table(combined_codelists, totals)
+    write_csv(
+        redact_small_numbers(
+            all_codes, "Total records", secondary=secondary_suppression
+        ),
+        "output/all_long_covid_codes.csv",
+        engine,
+    )
+    print(all_codes.columns)
+    return []
+
+
+def write_practice_descriptives(counts):
+    by_practice = practice_totals(counts)["coded"].rename("long_covid")
+    summary = [f"Total patients coded: {by_practice.sum()}"]
+    top_10_count = top_k(by_practice, 10).sum()
+    summary.append(f"Patients coded in the highest 10 practices: {top_10_count}")
+    practice_summ = by_practice.describe()
+    summary.append(f"Summary stats by practice:\n{practice_summ}")
+    practice_distribution = distribution(by_practice, practice_ranges, "long_covid")
+    summary.append(f"Distribution of coding within practices: {practice_distribution}")
+    write_csv(practice_distribution, "output/practice_distribution.csv")
+
+    # Rates need the list sizes, which come from the same counts
+    rate_distribution = distribution(
+        rates(practice_totals(counts)), practice_rate_ranges, "rate_per_100000"
+    )
+    write_csv(rate_distribution, "output/practice_rate_distribution.csv")
+    # Missing regions are labelled as in the counts table
+    regions = counts.index.to_frame()["region"].fillna("AaMissing")
+    by_region = grouped_distribution(counts["coded"], regions, practice_ranges)
+    write_csv(by_region, "output/practice_distribution_by_region.csv")
+    return summary
+
+
+## Incremental weekly counts: unrounded counts for weeks that have closed are
+## kept between runs, so that later runs only count the weeks after them. A
+## week has closed when it ended before the cohort was extracted, or, without
+## an extraction date, when there are dates in the weeks after it. The week
+## holding the latest date may not have been fully extracted. This is for
+## local runs: the job-runner only gives an action the outputs of the actions
+## it needs, never its own from an earlier run, so it would start each time
+## without a state
+def weekly_state_path(state_dir, variable):
+    return os.path.join(state_dir, f"weekly_{variable}.csv")
+
+
+def read_weekly_state(state_dir, variable):
+    if state_dir is None or not os.path.isfile(weekly_state_path(state_dir, variable)):
+        return None
+    state = pd.read_csv(
+        weekly_state_path(state_dir, variable), index_col=0, parse_dates=True
+    )
+    return state[variable]
+
+
+def last_closed_week(state_dir, variable):
+    state = read_weekly_state(state_dir, variable)
+    if state is None or state.empty:
+        return None
+    return state.index.max()
+
+
+def update_weekly_state(state_dir, variable, weekly_counts, as_of=None):
+    weekly_counts = add_counts(read_weekly_state(state_dir, variable), weekly_counts)
+    # Weeks are labelled with their last day
+    if as_of is None:
+        closed = weekly_counts.loc[weekly_counts.index < weekly_counts.index.max()]
+    else:
+        closed = weekly_counts.loc[weekly_counts.index < as_of]
+    write_csv(closed, weekly_state_path(state_dir, variable))
+    return weekly_counts
+
+
+def weekly_counts(variable, weekly_counts, state_dir=None, as_of=None):
+    if state_dir is not None:
+        weekly_counts = update_weekly_state(state_dir, variable, weekly_counts, as_of)
+    weekly_counts = weekly_counts.asfreq("W", fill_value=0)
     weekly_counts = weekly_counts.loc["2020-01-01":]
-    weekly_counts = weekly_counts.apply(lambda x: custom_round(x, base=5))
+    weekly_counts = round_to_base(weekly_counts, base=5)
     print(weekly_counts)
-    weekly_counts.to_csv(f"output/code_use_per_week_{variable}.csv")
-
+    write_csv(weekly_counts, f"output/code_use_per_week_{variable}.csv")
+    return []
 
-weekly_counts("long_covid")
-weekly_counts("post_viral_fatigue")
 
 ## COVID to long COVID interval
-def interval_until(col):
-    interval = (df[col] - first_covid_date).dt.days.dropna()
-    bins = [-1000, -1, 0, 28, 56, 84, 112, 140, 168, 196, 1000]
-    interval = interval.groupby(pd.cut(interval, bins)).count()
-    interval.loc[interval.isin([1, 2, 3, 4, 5])] = np.nan
-    write_to_file(f"Timing of {col} relative to COVID:\n{interval}")
-    interval.to_csv(f"output/interval_{col}.csv")
+def interval_until(col, interval):
+    interval = redact_small_numbers(interval)
+    write_csv(interval, f"output/interval_{col}.csv")
+    return [f"Timing of {col} relative to COVID:\n{interval}"]
+
+
+def write_intervals(intervals, engine="pandas"):
+    # One long table for every code, plus the reported intervals on their own
+    intervals = intervals.reindex(interval_columns, fill_value=0)
+    all_intervals = intervals.stack().rename("count")
+    write_csv(
+        redact_small_numbers(all_intervals), "output/interval_all_codes.csv", engine
+    )
+
+    summary = []
+    for col in reported_intervals:
+        interval = intervals.loc[col].rename(None).rename_axis(None)
+        summary += interval_until(col, interval)
+    return summary
+
+
+## Stages: the columns each one reads, how it counts a block of the cohort and
+## how it writes its outputs from the totals. Stages are independent of each
+## other, so they can be counted in separate processes. With the long-format
+## code events, the per-code counts come from blocks of events instead
+Stage = namedtuple(
+    "Stage", ["columns", "count", "write", "count_events"], defaults=[None]
+)
+
+
+def make_stages(
+    weekly_state=None,
+    secondary_suppression=False,
+    events=False,
+    csv_engine="pandas",
+    as_of=None,
+):
+    # `csv_engine` renders the tables that grow with the codelists
+    stages = {
+        "crosstabs": Stage(
+            ["long_covid"] + stratifiers,
+            count_crosstabs,
+            partial(write_crosstabs, secondary_suppression=secondary_suppression),
+        ),
+        "codes": Stage(
+            individual_codes,
+            count_codes,
+            partial(
+                write_codes_table,
+                secondary_suppression=secondary_suppression,
+                engine=csv_engine,
+            ),
+        ),
+        "practice": Stage(
+            ["long_covid", "practice_id", "region"],
+            count_by_practice,
+            write_practice_descriptives,
+        ),
+        **{
+            f"weekly_{v}": Stage(
+                [v, f"first_{v}_date"],
+                partial(
+                    weekly_partial,
+                    variable=v,
+                    since=last_closed_week(weekly_state, v),
+                ),
+                partial(weekly_counts, v, state_dir=weekly_state, as_of=as_of),
+            )
+            for v in weekly_variables
+        },
+        "intervals": Stage(
+            ["first_covid_date"] + interval_columns,
+            count_intervals,
+            partial(write_intervals, engine=csv_engine),
+        ),
+    }
+    if events:
+        stages["codes"] = Stage(
+            [], None, stages["codes"].write, count_events=count_code_events
+        )
+        stages["intervals"] = Stage(
+            ["first_covid_date", "first_long_covid_date"],
+            partial(count_intervals, columns=["first_long_covid_date"]),
+            stages["intervals"].write,
+            count_events=count_event_intervals,
+        )
+    return stages
+
+
+stages = make_stages()
+
+
+def count_stages(
+    names,
+    path,
+    chunk_size=None,
+    shard=None,
+    weekly_state=None,
+    events=None,
+    report=None,
+):
+    # One pass over the cohort, reading only the columns these stages need,
+    # then one over the code events if there are any. Returns the unredacted
+    # totals for each stage, and records how long each phase took in `report`
+    stages = make_stages(weekly_state, events=events is not None)
+    totals = dict.fromkeys(names)
+    report = {} if report is None else report
+
+    cohort_stages = [name for name in names if stages[name].count is not None]
+    columns = stage_columns(stages, cohort_stages, shard)
+    if cohort_stages:
+        cohort = read_cohort(path, columns, chunk_size)
+        for df in measured_blocks(cohort, report, "cohort"):
+            if shard is not None:
+                index, count = shard
+                df = df.loc[df["practice_id"] % count == index]
+            for name in cohort_stages:
+                with measure(report, name, "count") as sizes:
+                    totals[name] = add_counts(totals[name], stages[name].count(df))
+                    sizes["rows"] = len(df)
+
+    # Events are sharded by patient rather than by practice; every event is
+    # still counted in exactly one shard
+    event_stages = [name for name in names if stages[name].count_events is not None]
+    if event_stages:
+        blocks = read_events(events, path, chunk_size)
+        for block in measured_blocks(blocks, report, "events"):
+            if shard is not None:
+                index, count = shard
+                block = block.loc[block["patient_id"] % count == index]
+            for name in event_stages:
+                with measure(report, name, "count_events") as sizes:
+                    totals[name] = add_counts(
+                        totals[name], stages[name].count_events(block)
+                    )
+                    sizes["rows"] = len(block)
+    return totals
+
+
+def stage_columns(stages, names, shard=None):
+    columns = [c for name in names for c in stages[name].columns]
+    if shard is not None:
+        columns.append("practice_id")
+    return list(dict.fromkeys(columns))
+
+
+def count_stage(
+    name, path, chunk_size=None, shard=None, weekly_state=None, events=None
+):
+    # For a process of its own, so returns the stage's report with its totals
+    report = {}
+    totals = count_stages([name], path, chunk_size, shard, weekly_state, events, report)
+    return totals[name], report
+
+
+def merge_totals(all_totals):
+    # Reduce step for totals counted over separate shards of the cohort
+    totals = None
+    for shard_totals in all_totals:
+        if totals is None:
+            totals = shard_totals
+        else:
+            totals = {
+                name: add_counts(totals[name], shard_totals[name]) for name in stages
+            }
+    return totals
+
+
+def write_stages(
+    totals,
+    weekly_state=None,
+    secondary_suppression=False,
+    report=None,
+    csv_engine="pandas",
+    as_of=None,
+):
+    # Redaction and rounding happen here, only once all counts are in. The
+    # outputs are only rendered; flush() writes them out
+    stages = make_stages(
+        weekly_state, secondary_suppression, csv_engine=csv_engine, as_of=as_of
+    )
+    report = {} if report is None else report
+    summaries = {}
+    for name in stages:
+        with measure(report, name, "write"):
+            summaries[name] = stages[name].write(totals[name])
+
+    ## Descriptives by practice and COVID to long COVID intervals
+    write_text((text for name in stages for text in summaries[name]), results_path)
+
+
+def shard_spec(text):
+    index, count = (int(n) for n in text.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard: {text}")
+    return index, count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Counts by strata, codes, practice, week and interval. "
+        "To split the work across machines, count each shard of the cohort "
+        "with --save-partials, then write the outputs with --merge."
+    )
+    parser.add_argument(
+        "--input",
+        default="output/input_cohort.csv",
+        help="Cohort as written by generate_cohort, or by convert_cohort along "
+        "with --events",
+    )
+    parser.add_argument(
+        "--events",
+        metavar="PATH",
+        help="Count codes from the long-format code events written by "
+        "convert_cohort, rather than from per-code columns in the cohort",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="Stream the cohort in blocks of this many rows",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Run the stages in this many processes, which share one decoded "
+        "copy of the columns they read; needs the Parquet cohort",
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_spec,
+        default=None,
+        metavar="I/N",
+        help="Only count patients whose practice_id modulo N is I",
+    )
+    parser.add_argument(
+        "--save-partials",
+        metavar="PATH",
+        help="Save the unredacted totals to PATH instead of writing outputs",
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        metavar="PATH",
+        help="Write outputs from totals saved with --save-partials, instead of "
+        "reading a cohort",
+    )
+    parser.add_argument(
+        "--weekly-state",
+        metavar="DIR",
+        help="Keep unrounded counts for closed weeks in DIR, and only count "
+        "later weeks on the next run; for local runs, as actions don't keep "
+        "their outputs between runs",
+    )
+    parser.add_argument(
+        "--as-of",
+        type=pd.Timestamp,
+        metavar="DATE",
+        help="Date the cohort was extracted, before which weeks have closed; "
+        "by default, the week holding the latest date is taken to be open",
+    )
+    parser.add_argument(
+        "--secondary-suppression",
+        action="store_true",
+        help="Where a single count in the counts or codes table is redacted, "
+        "also redact the next smallest count in its group",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="Keep the totals of each stage in DIR, and reuse them while the "
+        "cohort, codelists and counting code are unchanged; for local runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        metavar="MB",
+        help="Evict the least recently used totals beyond this size",
+    )
+    parser.add_argument(
+        "--report",
+        default="output/run_report.csv",
+        metavar="PATH",
+        help="Where to write the time, CPU, peak memory, rows, bytes read and "
+        "block sizes of each phase of each stage",
+    )
+    parser.add_argument(
+        "--csv-engine",
+        choices=csv_engines,
+        default="pandas",
+        help="Render the codes and per-code interval tables with pyarrow, "
+        "which is faster for long codelists but formats values differently",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Also run under cProfile and save its stats to PATH, for pstats "
+        "or snakeviz; with --jobs, only the main process is profiled",
+    )
+    args = parser.parse_args()
+    if args.jobs > 1 and not args.merge and not args.input.endswith(".parquet"):
+        parser.error("--jobs needs the Parquet cohort written by convert_cohort")
+    # The converted cohort holds the per-code columns as code events instead
+    if not (args.merge or args.events):
+        if not set(individual_codes) <= set(cohort_columns(args.input)):
+            parser.error(
+                f"{args.input} has no per-code columns; pass the code events "
+                "written by convert_cohort with --events"
+            )
+
+    if args.profile:
+        import cProfile
+        import pstats
+
+        cProfile.runctx("run(args)", globals(), {"args": args}, args.profile)
+        pstats.Stats(args.profile).sort_stats("cumulative").print_stats(30)
+    else:
+        run(args)
+
+
+def share_inputs(names, args, shared_dir, report):
+    # Decodes the columns that the stages read from the cohort and the code
+    # events once, for the processes to share. Returns the shared copies
+    stages = make_stages(args.weekly_state, events=args.events is not None)
+    columns = stage_columns(stages, names, args.shard)
+    if args.events:
+        # The events are read with each patient's first COVID date
+        columns += ["patient_id", "first_covid_date"]
+    with measure(report, "cohort", "share") as sizes:
+        columns = source_columns(args.input, list(dict.fromkeys(columns)))[0]
+        cohort = os.path.join(shared_dir, "cohort.arrows")
+        sizes["bytes_read"] = write_shared(args.input, columns, cohort, args.chunk_size)
+    events = None
+    if args.events:
+        with measure(report, "events", "share") as sizes:
+            events = os.path.join(shared_dir, "code_events.arrows")
+            sizes["bytes_read"] = write_shared(
+                args.events, list(event_dtypes), events, args.chunk_size
+            )
+    return cohort, events
+
+
+def count_all(names, args, report):
+    if args.jobs > 1:
+        with tempfile.TemporaryDirectory() as shared_dir:
+            cohort, events = share_inputs(names, args, shared_dir, report)
+            with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+                totals = pool.map(
+                    count_stage,
+                    names,
+                    repeat(cohort),
+                    repeat(args.chunk_size),
+                    repeat(args.shard),
+                    repeat(args.weekly_state),
+                    repeat(events),
+                )
+                totals, reports = zip(*totals)
+        for stage_report in reports:
+            merge_reports(report, stage_report)
+        return dict(zip(names, totals))
+    return count_stages(
+        names,
+        args.input,
+        args.chunk_size,
+        args.shard,
+        args.weekly_state,
+        args.events,
+        report,
+    )
+
+
+def count_with_cache(names, args, report):
+    # Only the stages whose inputs, codelists or code have changed since they
+    # were cached are counted again
+    os.makedirs(args.cache, exist_ok=True)
+    counting = make_stages(args.weekly_state, events=args.events is not None)
+    inputs = [args.input] + ([args.events] if args.events else [])
+    keys = {}
+    totals = {}
+    for name in names:
+        with measure(report, name, "cache"):
+            keys[name] = stage_key(
+                name,
+                counting[name],
+                inputs,
+                args.cache,
+                args.shard,
+                readers=[read_cohort, read_events],
+                combiners=[count_stages, stage_columns, add_counts],
+            )
+            cached = read_entry(args.cache, keys[name])
+        if cached is not None:
+            totals[name] = cached
+
+    missing = [name for name in names if name not in totals]
+    if missing:
+        totals.update(count_all(missing, args, report))
+    for name in missing:
+        write_entry(args.cache, keys[name], totals[name])
+    evict(args.cache, args.cache_size << 20)
+    return {name: totals[name] for name in names}
+
+
+def run(args):
+    names = list(stages)
+    report = {}
+    if args.merge:
+        totals = merge_totals(pd.read_pickle(path) for path in args.merge)
+    elif args.cache:
+        totals = count_with_cache(names, args, report)
+    else:
+        totals = count_all(names, args, report)
+
+    if args.save_partials:
+        pd.to_pickle(totals, args.save_partials)
+    else:
+        write_stages(
+            totals,
+            args.weekly_state,
+            args.secondary_suppression,
+            report,
+            args.csv_engine,
+            args.as_of,
+        )
+    write_csv(report_table(report), args.report)
+    flush()
 
 
-for col in ["first_long_covid_date"] + individual_code_dates[0:5]:
-    interval_until(col)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import argparse
+import json
+import os
+import platform
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from aggregation import code_totals, codes_table, count_strata, interval_counts
+from all_time_counts import (
+    count_by_practice,
+    interval_bins,
+    weekly_partial,
+    weekly_variables,
+)
+from cohort import code_columns, combined_codelists, manifest, read_cohort, stratifiers
+
+## Benchmarks for the counting stages of all_time_counts.py and the report
+## tables in lib.py, on synthetic cohorts generated from the expectations in
+## the cohort manifest. Results are saved as JSON, to compare between runs:
+##     python analysis/benchmark.py --patients 10000 1000000 --output bench.json
+##     python analysis/benchmark.py --patients 10000 1000000 --compare bench.json
+
+stage_names = ["load", "crosstabs", "codes", "practice", "weekly", "intervals"]
+
+
+## Synthetic cohorts
+def synthetic_codes(n_codes):
+    # The real codes first, then made-up ones for longer codelists
+    codes = list(combined_codelists.index)
+    codes += [900000000000000000 + i for i in range(max(n_codes - len(codes), 0))]
+    return codes[:n_codes]
+
+
+def synthetic_dtypes(codes):
+    per_code = set(code_columns.values())
+    per_code |= {f"{c}_date" for c in per_code}
+    dtypes = {c: d for c, d in manifest["dtypes"].items() if c not in per_code}
+    for code in codes:
+        dtypes[f"snomed_{code}"] = "uint16"
+        dtypes[f"snomed_{code}_date"] = "date"
+    return dtypes
+
+
+def expectations_for(column):
+    # Per-code columns all share the expectations of the real ones
+    if column.startswith("snomed_"):
+        column = next(iter(code_columns.values()))
+    defaults = manifest["default_expectations"]
+    expectations = manifest["expectations"].get(column, {})
+    return {**defaults, **expectations}
+
+
+def day_range(expectations):
+    def day(value):
+        if value == "index_date":
+            value = manifest["index_date"]
+        if value == "today":
+            value = pd.Timestamp.today().normalize()
+        return pd.Timestamp(value).to_datetime64().astype("datetime64[D]")
+
+    dates = expectations["date"]
+    return day(dates.get("earliest", "index_date")), day(dates.get("latest", "today"))
+
+
+def synthetic_values(column, dtype, n, rng):
+    # Values like cohortextractor's dummy data: present for `incidence` of
+    # patients, or all of them when the rate is universal
+    expectations = expectations_for(column)
+    # A universal rate overrides the default incidence
+    if expectations.get("rate") == "universal":
+        incidence = 1
+    else:
+        incidence = expectations["incidence"]
+    present = rng.random(n) < incidence
+    if dtype == "bool":
+        return present
+    if dtype == "date":
+        earliest, latest = day_range(expectations)
+        days = rng.integers(0, (latest - earliest).astype(int) + 1, n)
+        dates = (earliest + days).astype("datetime64[ns]")
+        return pd.Series(np.where(present, dates, np.datetime64("NaT")))
+    if dtype in ("uint16", "int32"):
+        ints = expectations["int"]
+        values = rng.normal(ints["mean"], ints["stddev"], n).round().clip(0)
+        return np.where(present, values, 0).astype(dtype)
+    ratios = expectations["category"]["ratios"]
+    p = np.array(list(ratios.values()), dtype="float64")
+    values = rng.choice(list(ratios), n, p=p / p.sum())
+    return pd.Series(pd.Categorical(values)).where(present)
+
+
+def synthetic_block(dtypes, n, rng, first_id):
+    block = {"patient_id": np.arange(first_id, first_id + n)}
+    for column, dtype in dtypes.items():
+        if column.startswith("snomed_") and column.endswith("_date"):
+            # Dates of match only where the code was matched
+            matched = block[column[: -len("_date")]] > 0
+            dates = synthetic_values(column, dtype, n, rng).where(matched)
+            block[column] = dates
+        else:
+            block[column] = synthetic_values(column, dtype, n, rng)
+    return pd.DataFrame(block)
+
+
+def synthetic_cohort(path, n_patients, codes, seed=0, block_size=1_000_000):
+    # Written in blocks as Parquet, so that cohorts of tens of millions of
+    # patients needn't fit in memory at once
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rng = np.random.default_rng(seed)
+    dtypes = synthetic_dtypes(codes)
+    writer = None
+    for first_id in range(0, n_patients, block_size):
+        n = min(block_size, n_patients - first_id)
+        table = pa.Table.from_pandas(
+            synthetic_block(dtypes, n, rng, first_id + 1), preserve_index=False
+        )
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table.cast(writer.schema))
+    writer.close()
+
+
+## Measurement
+@contextmanager
+def measure(results, stage, trace=False):
+    # Adds the time spent in the block to the stage, and with `trace`, raises
+    # its peak to the most memory allocated in the block. tracemalloc sees
+    # numpy's allocations but not Arrow's, which hold the columns as read
+    if trace:
+        # Restarted, so that only allocations made in the block are counted
+        tracemalloc.stop()
+        tracemalloc.start()
+    start = time.perf_counter()
+    yield
+    results[stage]["seconds"] += time.perf_counter() - start
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        results[stage]["peak_bytes"] = max(results[stage]["peak_bytes"], peak)
+
+
+def run_stages(path, codes, chunk_size=None, trace=False):
+    code_dates = [f"snomed_{code}_date" for code in codes]
+    intervals = ["first_long_covid_date"] + code_dates
+    codelists = pd.DataFrame({"term": ""}, index=pd.Index(codes, name="code"))
+    columns = list(synthetic_dtypes(codes)) + ["first_covid_date"]
+    results = {s: {"seconds": 0.0, "peak_bytes": 0, "rows": 0} for s in stage_names}
+
+    blocks = read_cohort(path, columns, chunk_size)
+    while True:
+        with measure(results, "load", trace):
+            df = next(blocks, None)
+        if df is None:
+            break
+        for stage in stage_names:
+            results[stage]["rows"] += len(df)
+        with measure(results, "crosstabs", trace):
+            count_strata(df, stratifiers, "long_covid")
+        with measure(results, "codes", trace):
+            codes_table(codelists, code_totals(df, codes))
+        with measure(results, "practice", trace):
+            count_by_practice(df)
+        with measure(results, "weekly", trace):
+            for v in weekly_variables:
+                weekly_partial(df, v)
+        with measure(results, "intervals", trace):
+            interval_counts(df, intervals, df["first_covid_date"], interval_bins)
+        del df
+    return results
+
+
+def benchmark_cohort(path, codes, chunk_size=None, repeat=3):
+    # Times are the best of `repeat` runs. Memory is measured in a separate
+    # run, as tracing allocations slows everything down
+    runs = [run_stages(path, codes, chunk_size) for _ in range(repeat)]
+    try:
+        traced = run_stages(path, codes, chunk_size, trace=True)
+    finally:
+        tracemalloc.stop()
+    for stage, result in traced.items():
+        result["seconds"] = min(run[stage]["seconds"] for run in runs)
+    return traced
+
+
+def benchmark_report(repeat=3):
+    # The tables of the report, on the released outputs
+    import lib
+
+    def tables():
+        tpp = lib.tpp_emis_table_format("output", {"0": "Missing"})
+        emis = lib.tpp_emis_table_format(
+            "emis", {"RGN11NM": "region", "0": "Missing", "6": "Missing"}
+        )
+        lib.report_tables(lib.add_totals({"TPP": tpp, "EMIS": emis}))
+        lib.smoosh_codes_tables()
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tables()
+        seconds.append(time.perf_counter() - start)
+    return {"report_tables": {"seconds": min(seconds)}}
+
+
+## Comparison with an earlier run
+def result_key(result):
+    return (result["patients"], result["codes"], result["stage"])
+
+
+def compare(results, baseline, tolerance=1.2):
+    # Prints the change in time for every stage in both runs, and returns the
+    # stages that got slower by more than `tolerance`
+    baseline = {result_key(r): r for r in baseline["results"]}
+    slower = []
+    for result in results["results"]:
+        before = baseline.get(result_key(result))
+        if before is None or not before["seconds"]:
+            continue
+        ratio = result["seconds"] / before["seconds"]
+        flag = " SLOWER" if ratio > tolerance else ""
+        print(
+            f"{result['stage']:>14} {result['patients']:>10} patients "
+            f"{result['codes']:>4} codes: {before['seconds']:.3f}s -> "
+            f"{result['seconds']:.3f}s ({ratio:.2f}x){flag}"
+        )
+        if flag:
+            slower.append(result_key(result))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time and memory-profile the counting stages on synthetic "
+        "cohorts, and the report tables on the released outputs"
+    )
+    parser.add_argument(
+        "--patients",
+        type=int,
+        nargs="+",
+        default=[10000],
+        help="Cohort sizes, e.g. 10000 1000000 10000000 25000000",
+    )
+    parser.add_argument(
+        "--codes",
+        type=int,
+        nargs="+",
+        default=[len(combined_codelists)],
+        help="Number of per-code columns; longer than the codelists adds "
+        "made-up codes",
+    )
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--data-dir",
+        default="output/benchmark",
+        help="Where synthetic cohorts are kept, to be reused by later runs",
+    )
+    parser.add_argument(
+        "--report", action="store_true", help="Also time the lib.py tables"
+    )
+    parser.add_argument("--output", metavar="PATH", help="Save the results as JSON")
+    parser.add_argument(
+        "--compare",
+        metavar="PATH",
+        help="Compare with results saved earlier, failing if a stage is slower",
+    )
+    parser.add_argument("--tolerance", type=float, default=1.2)
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "chunk_size": args.chunk_size,
+        "results": [],
+    }
+    os.makedirs(args.data_dir, exist_ok=True)
+    for n_patients in args.patients:
+        for n_codes in args.codes:
+            path = os.path.join(
+                args.data_dir, f"cohort_{n_patients}_{n_codes}_{args.seed}.parquet"
+            )
+            codes = synthetic_codes(n_codes)
+            if not os.path.isfile(path):
+                synthetic_cohort(path, n_patients, codes, args.seed)
+            stages = benchmark_cohort(path, codes, args.chunk_size, args.repeat)
+            for stage, result in stages.items():
+                results["results"].append(
+                    {
+                        "patients": n_patients,
+                        "codes": n_codes,
+                        "stage": stage,
+                        **result,
+                    }
+                )
+                print(results["results"][-1])
+    if args.report:
+        for stage, result in benchmark_report(args.repeat).items():
+            results["results"].append(
+                {"patients": None, "codes": None, "stage": stage, **result}
+            )
+            print(results["results"][-1])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        if slower:
+            parser.exit(1, f"{len(slower)} stages are slower than before\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import pandas as pd
+
+## One index of every code in the codelists the study uses, as rows of
+## (code, codelist, category, term) indexed on the code. It is compiled from
+## the CSVs once and kept in a binary cache, which is rebuilt whenever
+## codelists.json, one of the CSVs, the codelist specs or the version of
+## pandas change. The cache's key is kept beside it as text, so that a cache
+## pickled by another version of pandas is never read. A cache that can't be
+## read or written only means that the index is compiled again
+
+codelists_dir = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "codelists"
+)
+cache_path = os.path.join(codelists_dir, ".codelist_index.pickle")
+key_path = os.path.join(codelists_dir, ".codelist_index.key")
+term_columns = [
+    "term",
+    "CTV3PreferredTermDesc",
+    "readterm/CTV3PreferredTermDesc",
+    "Description",
+    "name",
+    "nm",
+    "dmd_name",
+]
+
+
+def csv_path(codelist):
+    return os.path.join(codelists_dir, f"{codelist}.csv")
+
+
+def source_key(specs):
+    key = hashlib.sha1(repr((sorted(specs.items()), pd.__version__)).encode())
+    files = ["codelists.json"] + sorted(f"{c}.csv" for c in specs)
+    for file in files:
+        with open(os.path.join(codelists_dir, file), "rb") as f:
+            key.update(hashlib.sha1(f.read()).digest())
+    return key.hexdigest()
+
+
+def read_codelist(codelist, column, category_column=None):
+    # Codes and categories are stripped of whitespace, as codelist_from_csv
+    # does
+    rows = pd.read_csv(csv_path(codelist), dtype=str, keep_default_na=False)
+    term = next((c for c in term_columns if c in rows.columns), None)
+    return pd.DataFrame(
+        {
+            "code": rows[column].str.strip(),
+            "codelist": codelist,
+            "category": rows[category_column].str.strip() if category_column else None,
+            "term": rows[term] if term else None,
+        }
+    )
+
+
+def compile_index(specs):
+    # `specs` maps each codelist to the columns that hold its codes and
+    # categories. Codes keep their order within each codelist
+    codelists = [read_codelist(c, *columns) for c, columns in specs.items()]
+    index = pd.concat(codelists, ignore_index=True).set_index("code")
+    index["codelist"] = index["codelist"].astype("category")
+    return index
+
+
+def read_cache(key):
+    if not (os.path.isfile(key_path) and os.path.isfile(cache_path)):
+        return None
+    with open(key_path) as f:
+        if f.read() != key:
+            return None
+    try:
+        cached = pd.read_pickle(cache_path)
+    except Exception:
+        # Truncated, or otherwise unreadable however it was written
+        return None
+    # The pickle holds its key too, in case it was replaced after the key
+    if not isinstance(cached, dict) or cached.get("key") != key:
+        return None
+    return cached["index"]
+
+
+def write_cache(key, index):
+    # The key is written last, once the pickle it describes is in place
+    try:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        pd.to_pickle({"key": key, "index": index}, tmp_path)
+        os.replace(tmp_path, cache_path)
+        tmp_path = f"{key_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(key)
+        os.replace(tmp_path, key_path)
+    except OSError:
+        # Such as in a read-only checkout
+        pass
+
+
+def load_index(specs):
+    key = source_key(specs)
+    index = read_cache(key)
+    if index is None:
+        index = compile_index(specs)
+        write_cache(key, index)
+    return index
@@ -1,149 +1,186 @@
-from cohortextractor import codelist, codelist_from_csv, combine_codelists
+import sys
+import pandas as pd
+from codelist_index import load_index
 
-covid_codes = codelist_from_csv(
-    "codelists/opensafely-covid-identification.csv",
-    system="icd10",
-    column="icd10_code",
-)
-covid_primary_care_positive_test = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-covid_primary_care_code = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-covid_primary_care_sequalae = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-any_primary_care_code = combine_codelists(
-    covid_primary_care_code,
-    covid_primary_care_positive_test,
-    covid_primary_care_sequalae,
-)
-long_covid_diagnostic_codes = codelist_from_csv(
-    "codelists/opensafely-nice-managing-the-long-term-effects-of-covid-19.csv",
-    system="snomed",
-    column="code",
-)
-long_covid_referral_codes = codelist_from_csv(
-    "codelists/opensafely-referral-and-signposting-for-long-covid.csv",
-    system="snomed",
-    column="code",
-)
-long_covid_assessment_codes = codelist_from_csv(
-    "codelists/opensafely-assessment-instruments-and-outcome-measures-for-long-covid.csv",
-    system="snomed",
-    column="code",
-)
-any_long_covid_code = combine_codelists(
-    long_covid_diagnostic_codes, long_covid_referral_codes, long_covid_assessment_codes
-)
-post_viral_fatigue_codes = codelist_from_csv(
-    "codelists/user-alex-walker-post-viral-syndrome.csv",
-    system="snomed",
-    column="code",
-)
-ethnicity_codes = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    system="ctv3",
-    column="Code",
-    category_column="Grouping_6",
-)
-dementia_codes = codelist_from_csv(
-    "codelists/opensafely-dementia.csv", system="ctv3", column="CTV3ID"
-)
-other_neuro_codes = codelist_from_csv(
-    "codelists/opensafely-other-neurological-conditions.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-chronic_respiratory_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-respiratory-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-asthma_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-diagnosis.csv", system="ctv3", column="CTV3ID"
-)
-salbutamol_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-inhaler-salbutamol-medication.csv",
-    system="snomed",
-    column="id",
-)
-ics_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-inhaler-steroid-medication.csv",
-    system="snomed",
-    column="id",
-)
-prednisolone_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-oral-prednisolone-medication.csv",
-    system="snomed",
-    column="snomed_id",
-)
-clear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-clear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-stroke_gp_codes = codelist_from_csv(
-    "codelists/opensafely-stroke-updated.csv", system="ctv3", column="CTV3ID"
-)
-lung_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-lung-cancer.csv", system="ctv3", column="CTV3ID"
-)
-haem_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-haematological-cancer.csv", system="ctv3", column="CTV3ID"
-)
-other_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-chronic_cardiac_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-cardiac-disease.csv", system="ctv3", column="CTV3ID"
-)
-hiv_codes = codelist_from_csv(
-    "codelists/opensafely-hiv.csv",
-    system="ctv3",
-    column="CTV3ID",
-    category_column="CTV3ID",
-)
-permanent_immune_codes = codelist_from_csv(
-    "codelists/opensafely-permanent-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-temp_immune_codes = codelist_from_csv(
-    "codelists/opensafely-temporary-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-aplastic_codes = codelist_from_csv(
-    "codelists/opensafely-aplastic-anaemia.csv", system="ctv3", column="CTV3ID"
-)
-spleen_codes = codelist_from_csv(
-    "codelists/opensafely-asplenia.csv", system="ctv3", column="CTV3ID"
-)
-organ_transplant_codes = codelist_from_csv(
-    "codelists/opensafely-solid-organ-transplantation.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-sickle_cell_codes = codelist_from_csv(
-    "codelists/opensafely-sickle-cell-disease.csv", system="ctv3", column="CTV3ID"
-)
-ra_sle_psoriasis_codes = codelist_from_csv(
-    "codelists/opensafely-ra-sle-psoriasis.csv", system="ctv3", column="CTV3ID"
-)
-chronic_liver_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-liver-disease.csv", system="ctv3", column="CTV3ID"
-)
-diabetes_codes = codelist_from_csv(
-    "codelists/opensafely-diabetes.csv", system="ctv3", column="CTV3ID"
-)
+## Codelists are built from the compiled codelist index the first time they
+## are used, rather than each CSV being read when this module is imported, and
+## cohortextractor is only imported then too.
+## Each one is (CSV in codelists/, coding system, code column, category column)
+codelist_specs = {
+    "covid_codes": ("opensafely-covid-identification", "icd10", "icd10_code", None),
+    "covid_primary_care_positive_test": (
+        "opensafely-covid-identification-in-primary-care-probable-covid-positive-test",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "covid_primary_care_code": (
+        "opensafely-covid-identification-in-primary-care-probable-covid-clinical-code",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "covid_primary_care_sequalae": (
+        "opensafely-covid-identification-in-primary-care-probable-covid-sequelae",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "long_covid_diagnostic_codes": (
+        "opensafely-nice-managing-the-long-term-effects-of-covid-19",
+        "snomed",
+        "code",
+        None,
+    ),
+    "long_covid_referral_codes": (
+        "opensafely-referral-and-signposting-for-long-covid",
+        "snomed",
+        "code",
+        None,
+    ),
+    "long_covid_assessment_codes": (
+        "opensafely-assessment-instruments-and-outcome-measures-for-long-covid",
+        "snomed",
+        "code",
+        None,
+    ),
+    "post_viral_fatigue_codes": (
+        "user-alex-walker-post-viral-syndrome",
+        "snomed",
+        "code",
+        None,
+    ),
+    "ethnicity_codes": ("opensafely-ethnicity", "ctv3", "Code", "Grouping_6"),
+    "dementia_codes": ("opensafely-dementia", "ctv3", "CTV3ID", None),
+    "other_neuro_codes": (
+        "opensafely-other-neurological-conditions",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "chronic_respiratory_disease_codes": (
+        "opensafely-chronic-respiratory-disease",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "asthma_codes": ("opensafely-asthma-diagnosis", "ctv3", "CTV3ID", None),
+    "salbutamol_codes": (
+        "opensafely-asthma-inhaler-salbutamol-medication",
+        "snomed",
+        "id",
+        None,
+    ),
+    "ics_codes": ("opensafely-asthma-inhaler-steroid-medication", "snomed", "id", None),
+    "prednisolone_codes": (
+        "opensafely-asthma-oral-prednisolone-medication",
+        "snomed",
+        "snomed_id",
+        None,
+    ),
+    "clear_smoking_codes": ("opensafely-smoking-clear", "ctv3", "CTV3Code", "Category"),
+    "stroke_gp_codes": ("opensafely-stroke-updated", "ctv3", "CTV3ID", None),
+    "lung_cancer_codes": ("opensafely-lung-cancer", "ctv3", "CTV3ID", None),
+    "haem_cancer_codes": ("opensafely-haematological-cancer", "ctv3", "CTV3ID", None),
+    "other_cancer_codes": (
+        "opensafely-cancer-excluding-lung-and-haematological",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "chronic_cardiac_disease_codes": (
+        "opensafely-chronic-cardiac-disease",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "hiv_codes": ("opensafely-hiv", "ctv3", "CTV3ID", "CTV3ID"),
+    "permanent_immune_codes": (
+        "opensafely-permanent-immunosuppression",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "temp_immune_codes": (
+        "opensafely-temporary-immunosuppression",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "aplastic_codes": ("opensafely-aplastic-anaemia", "ctv3", "CTV3ID", None),
+    "spleen_codes": ("opensafely-asplenia", "ctv3", "CTV3ID", None),
+    "organ_transplant_codes": (
+        "opensafely-solid-organ-transplantation",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "sickle_cell_codes": ("opensafely-sickle-cell-disease", "ctv3", "CTV3ID", None),
+    "ra_sle_psoriasis_codes": ("opensafely-ra-sle-psoriasis", "ctv3", "CTV3ID", None),
+    "chronic_liver_disease_codes": (
+        "opensafely-chronic-liver-disease",
+        "ctv3",
+        "CTV3ID",
+        None,
+    ),
+    "diabetes_codes": ("opensafely-diabetes", "ctv3", "CTV3ID", None),
+}
+combined_codelists = {
+    "any_primary_care_code": [
+        "covid_primary_care_code",
+        "covid_primary_care_positive_test",
+        "covid_primary_care_sequalae",
+    ],
+    "any_long_covid_code": [
+        "long_covid_diagnostic_codes",
+        "long_covid_referral_codes",
+        "long_covid_assessment_codes",
+    ],
+}
+__all__ = list(codelist_specs) + list(combined_codelists)
+
+_index = None
+
+
+def codelist_index():
+    global _index
+    if _index is None:
+        _index = load_index(
+            {
+                file: (column, category)
+                for file, _, column, category in codelist_specs.values()
+            }
+        )
+    return _index
+
+
+def codelist_table(files):
+    # Rows of the index for these codelists, in the order of their CSVs
+    index = codelist_index()
+    return pd.concat([index.loc[index["codelist"] == file] for file in files])
+
+
+def build_codelist(name):
+    from cohortextractor import codelist
+
+    file, system, column, category = codelist_specs[name]
+    rows = codelist_table([file])
+    if category is None:
+        return codelist(list(rows.index), system=system)
+    return codelist(list(zip(rows.index, rows["category"])), system=system)
+
+
+def __getattr__(name):
+    if name in codelist_specs:
+        value = build_codelist(name)
+    elif name in combined_codelists:
+        from cohortextractor import combine_codelists
+
+        module = sys.modules[__name__]
+        value = combine_codelists(
+            *(getattr(module, n) for n in combined_codelists[name])
+        )
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
@@ -0,0 +1,251 @@
+import numpy as np
+import pandas as pd
+from codelists import codelist_table
+from manifest import covid_dates, read_manifest
+
+manifest = read_manifest()
+stratifiers = manifest["stratifiers"]
+long_covid_codelists = [
+    "opensafely-nice-managing-the-long-term-effects-of-covid-19",
+    "opensafely-referral-and-signposting-for-long-covid",
+    "opensafely-assessment-instruments-and-outcome-measures-for-long-covid",
+    "user-alex-walker-post-viral-syndrome",
+]
+combined_codelists = codelist_table(long_covid_codelists)[["term"]]
+combined_codelists.index = combined_codelists.index.astype("int64")
+individual_codes = [f"snomed_{c}" for c in combined_codelists.index]
+individual_code_dates = [f"snomed_{c}_date" for c in combined_codelists.index]
+
+
+## Columns written by study_definition_cohort, by dtype
+dtypes = manifest["dtypes"]
+date_columns = [c for c, dtype in dtypes.items() if dtype == "date"]
+
+# Columns derived from others when the cohort doesn't already hold them, as
+# the converted cohort does
+derived_columns = {
+    "first_covid_date": covid_dates,
+    "first_covid_source": covid_dates,
+}
+
+
+# The per-code columns, snomed_<code> and snomed_<code>_date, are almost all
+# empty. The converted cohort holds them as a long-format table of code events
+# instead, with one row for each patient and code with a match
+code_columns = {
+    int(c[len("snomed_") :]): c
+    for c in dtypes
+    if c.startswith("snomed_") and not c.endswith("_date")
+}
+event_dtypes = {
+    "patient_id": "int64",
+    "code": "int64",
+    "date": "date",
+    "count": "uint16",
+}
+
+
+def first_covid(df):
+    # Earliest COVID date and the column it came from, keeping a running
+    # minimum over the int64 nanoseconds of each date column rather than a
+    # row-wise min over a temporary frame
+    earliest = np.full(len(df), np.iinfo(np.int64).max)
+    source = np.full(len(df), -1)
+    for i, col in enumerate(covid_dates):
+        dates = df[col].to_numpy(dtype="datetime64[ns]")
+        earlier = ~np.isnat(dates) & (dates.view("int64") < earliest)
+        earliest[earlier] = dates.view("int64")[earlier]
+        source[earlier] = i
+    earliest[source < 0] = np.datetime64("NaT").astype("datetime64[ns]").view("int64")
+    return (
+        pd.Series(earliest.view("datetime64[ns]"), index=df.index),
+        pd.Series(pd.Categorical.from_codes(source, covid_dates), index=df.index),
+    )
+
+
+def add_derived_columns(df, columns):
+    if "first_covid_date" in columns or "first_covid_source" in columns:
+        df["first_covid_date"], df["first_covid_source"] = first_covid(df)
+    return df
+
+
+def code_events(df):
+    events = []
+    for code, col in code_columns.items():
+        matched = ((df[col] > 0) | df[f"{col}_date"].notna()).to_numpy()
+        events.append(
+            pd.DataFrame(
+                {
+                    "patient_id": df["patient_id"].to_numpy()[matched],
+                    "code": code,
+                    "date": df[f"{col}_date"].to_numpy()[matched],
+                    "count": df[col].fillna(0).to_numpy()[matched].astype("uint16"),
+                }
+            )
+        )
+    return pd.concat(events, ignore_index=True)
+
+
+def cohort_columns(path):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        return pq.read_schema(path).names
+    if path.endswith(".arrows"):
+        import pyarrow as pa
+
+        return pa.ipc.open_stream(pa.memory_map(path)).schema.names
+    return pd.read_csv(path, nrows=0).columns
+
+
+def source_columns(path, columns):
+    # The columns to read from the file for `columns`, and those of `columns`
+    # that are derived from them
+    available = cohort_columns(path)
+    derived = [c for c in columns if c in derived_columns and c not in available]
+    needed = [c for c in columns if c not in derived]
+    needed += [c for d in derived for c in derived_columns[d] if c not in needed]
+    return needed, derived
+
+
+def read_cohort(path, columns, chunk_size=None):
+    # Reads only the given columns. With a chunk size, yields successive
+    # blocks of rows so that peak memory depends on the chunk size rather
+    # than on the size of the cohort
+    needed, derived = source_columns(path, columns)
+    if path.endswith(".parquet") or path.endswith(".arrows"):
+        cohort = read_columns(path, needed, chunk_size)
+    else:
+        cohort = read_csv(path, needed, chunk_size)
+    for df in cohort:
+        yield add_derived_columns(df, derived)
+
+
+## Each block read is given the number of bytes read from the file for it,
+## as df.attrs["bytes_read"], for the run report
+def read_csv(path, columns, chunk_size=None):
+    with open(path, "rb") as f:
+        cohort = pd.read_csv(
+            f,
+            usecols=columns,
+            parse_dates=[c for c in date_columns if c in columns],
+            dtype={
+                c: dtype
+                for c, dtype in dtypes.items()
+                if c in columns and dtype != "date"
+            },
+            chunksize=chunk_size,
+        )
+        if chunk_size is None:
+            cohort = [cohort]
+        position = 0
+        for df in cohort:
+            df.attrs["bytes_read"] = f.tell() - position
+            position = f.tell()
+            yield df
+
+
+def read_columns(path, columns, chunk_size=None):
+    if path.endswith(".arrows"):
+        return read_shared(path, columns, chunk_size)
+    return read_parquet(path, columns, chunk_size)
+
+
+def row_group_bytes(parquet, columns):
+    # Compressed size of the columns in each row group, from the metadata
+    metadata = parquet.metadata
+    return np.array(
+        [
+            sum(
+                group.column(i).total_compressed_size
+                for i in range(group.num_columns)
+                if group.column(i).path_in_schema.split(".")[0] in columns
+            )
+            for group in map(metadata.row_group, range(metadata.num_row_groups))
+        ],
+        dtype="int64",
+    )
+
+
+def read_parquet(path, columns, chunk_size=None):
+    import pyarrow.parquet as pq
+
+    # Memory-mapped, so that processes reading the same file share its pages
+    cohort = pq.ParquetFile(path, memory_map=True)
+    group_bytes = row_group_bytes(cohort, columns)
+    if chunk_size is None:
+        df = cohort.read(columns=columns).to_pandas(date_as_object=False)
+        df.attrs["bytes_read"] = int(group_bytes.sum())
+        yield df
+    else:
+        # A row group is read for the block holding its first row
+        group_starts = np.cumsum(
+            [0]
+            + [cohort.metadata.row_group(i).num_rows for i in range(len(group_bytes))]
+        )[:-1]
+        start = 0
+        for batch in cohort.iter_batches(batch_size=chunk_size, columns=columns):
+            end = start + batch.num_rows
+            df = batch.to_pandas(date_as_object=False)
+            read = (group_starts >= start) & (group_starts < end)
+            df.attrs["bytes_read"] = int(group_bytes[read].sum())
+            start = end
+            yield df
+
+
+def read_events(path, cohort_path, chunk_size=None):
+    # Code events, each with its patient's first COVID date. The events are
+    # sparse, so only the dates of patients with events are kept from the
+    # cohort
+    patients = next(read_columns(path, ["patient_id"]))
+    bytes_read = patients.attrs["bytes_read"]
+    patients = np.unique(patients["patient_id"].to_numpy())
+    first_covid_dates = []
+    for df in read_cohort(cohort_path, ["patient_id", "first_covid_date"], chunk_size):
+        bytes_read += df.attrs["bytes_read"]
+        df = df.loc[df["patient_id"].isin(patients) & df["first_covid_date"].notna()]
+        first_covid_dates.append(df.set_index("patient_id")["first_covid_date"])
+    first_covid_dates = pd.concat(first_covid_dates)
+
+    for events in read_columns(path, list(event_dtypes), chunk_size):
+        events["first_covid_date"] = events["patient_id"].map(first_covid_dates)
+        # What was read to find the dates is counted with the first block
+        events.attrs["bytes_read"] += bytes_read
+        bytes_read = 0
+        yield events
+
+
+## Columns shared between processes. They are decoded from Parquet once, into
+## an uncompressed Arrow IPC stream that each process memory-maps, so that
+## the processes read the same pages of decoded values rather than each
+## decompressing and decoding the Parquet file again. The stream holds blocks
+## of the chunk size, each with its own dictionaries for categorical columns
+def write_shared(path, columns, shared_path, chunk_size=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(path, memory_map=True)
+    schema = parquet.schema_arrow
+    schema = pa.schema([schema.field(c) for c in columns], metadata=schema.metadata)
+    batches = parquet.iter_batches(batch_size=chunk_size or 65536, columns=columns)
+    with pa.ipc.new_stream(shared_path, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+    # The bytes read from the Parquet file
+    return int(row_group_bytes(parquet, columns).sum())
+
+
+def read_shared(path, columns, chunk_size=None):
+    import pyarrow as pa
+
+    # The values are read where they lie in the stream, so the bytes read are
+    # those of the columns' buffers
+    stream = pa.ipc.open_stream(pa.memory_map(path))
+    if chunk_size is None:
+        tables = [stream.read_all().select(columns)]
+    else:
+        tables = (pa.Table.from_batches([batch]).select(columns) for batch in stream)
+    for table in tables:
+        df = table.to_pandas(date_as_object=False)
+        df.attrs["bytes_read"] = table.nbytes
+        yield df
@@ -1,7 +1,35 @@
-from cohortextractor import patients
+from cohortextractor import patients, codelist
 from codelists import *
 
 
+pandemic_start = "2020-02-01"
+
+
+def make_variable(code):
+    return {
+        f"snomed_{code}": (
+            patients.with_these_clinical_events(
+                codelist([code], system="snomed"),
+                on_or_after=pandemic_start,
+                returning="number_of_matches_in_period",
+                include_date_of_match=True,
+                date_format="YYYY-MM-DD",
+                return_expectations={
+                    "incidence": 0.1,
+                    "int": {"distribution": "normal", "mean": 3, "stddev": 1},
+                },
+            )
+        )
+    }
+
+
+def loop_over_codes(code_list):
+    variables = {}
+    for code in code_list:
+        variables.update(make_variable(code))
+    return variables
+
+
 demographic_variables = dict(
     age_group=patients.categorised_as(
         {
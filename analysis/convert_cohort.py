@@ -0,0 +1,85 @@
+import argparse
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+from cohort import code_columns, code_events, covid_dates, dtypes, first_covid
+
+## Converts the text cohort written by generate_cohort into a typed, columnar
+## file once, so that later actions only read the columns they need. The
+## per-code columns go into a separate long-format table of code events
+
+arrow_types = {
+    "date": pa.date32(),
+    "bool": pa.bool_(),
+    "uint16": pa.uint16(),
+    "int32": pa.int32(),
+    "category": pa.dictionary(pa.int32(), pa.string()),
+}
+column_types = {
+    "patient_id": pa.int64(),
+    **{c: arrow_types[dtype] for c, dtype in dtypes.items()},
+}
+event_schema = pa.schema(
+    [
+        ("patient_id", pa.int64()),
+        ("code", pa.int64()),
+        ("date", pa.date32()),
+        ("count", pa.uint16()),
+    ]
+)
+per_code_columns = [c for col in code_columns.values() for c in [col, f"{col}_date"]]
+
+
+def convert(csv_path, parquet_path, events_path, block_size=64 << 20):
+    reader = csv.open_csv(
+        csv_path,
+        read_options=csv.ReadOptions(block_size=block_size),
+        convert_options=csv.ConvertOptions(
+            column_types=column_types,
+            include_columns=list(column_types),
+            strings_can_be_null=True,
+        ),
+    )
+    schema = pa.schema(f for f in reader.schema if f.name not in per_code_columns)
+    schema = schema.append(pa.field("first_covid_date", pa.date32())).append(
+        pa.field("first_covid_source", arrow_types["category"])
+    )
+    with pq.ParquetWriter(parquet_path, schema) as writer, pq.ParquetWriter(
+        events_path, event_schema
+    ) as events_writer:
+        for batch in reader:
+            writer.write_table(with_first_covid(batch, schema))
+            events_writer.write_table(events_table(batch))
+
+
+def events_table(batch):
+    df = batch.select(["patient_id"] + per_code_columns).to_pandas(date_as_object=False)
+    return pa.Table.from_pandas(code_events(df), event_schema, preserve_index=False)
+
+
+def with_first_covid(batch, schema):
+    # Stores the earliest COVID date and its source alongside the columns
+    # they come from, so that readers of the converted cohort needn't derive
+    # them again
+    covid = batch.select(covid_dates).to_pandas(date_as_object=False)
+    first_covid_date, first_covid_source = first_covid(covid)
+    table = pa.Table.from_batches([batch])
+    table = table.append_column(
+        "first_covid_date", pa.array(first_covid_date, type=pa.date32())
+    )
+    table = table.append_column(
+        "first_covid_source",
+        pa.DictionaryArray.from_pandas(first_covid_source).cast(
+            arrow_types["category"]
+        ),
+    )
+    return table.select(schema.names).cast(schema)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input_cohort.csv")
+    parser.add_argument("--output", default="output/input_cohort.parquet")
+    parser.add_argument("--events", default="output/code_events.parquet")
+    args = parser.parse_args()
+    convert(args.input, args.output, args.events)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+## Statistical disclosure control for released counts, on whole Series and
+## DataFrames at once
+
+
+def round_to_base(counts, base=5):
+    # np.round rounds halves to even, like the built-in round() this replaces
+    return (base * np.round(counts / base)).astype("int64")
+
+
+def small_numbers(values, threshold=5):
+    values = values.to_numpy(dtype="float64", na_value=np.nan)
+    return (values >= 1) & (values <= threshold)
+
+
+def secondary_mask(values, mask, by=None):
+    # A single suppressed value in a group can be recovered from the group's
+    # total, so the next smallest value in that group is suppressed as well.
+    # Groups are index levels, or the whole table when `by` is None
+    keys = dict(level=by) if by is not None else dict(by=np.zeros(len(values)))
+    mask = pd.Series(mask, index=values.index)
+    n_suppressed = mask.groupby(**keys).transform("sum")
+    candidates = values.where(~mask & (values > 0) & (n_suppressed == 1))
+    next_smallest = candidates.groupby(**keys).transform("min")
+    return candidates.eq(next_smallest).to_numpy()
+
+
+def redact_small_numbers(df, column=None, threshold=5, secondary=False, by=None):
+    # Blanks every row whose count is between 1 and the threshold. `df` may
+    # be a Series of counts, or a DataFrame with the counts in `column`
+    values = df if column is None else df[column]
+    mask = small_numbers(values, threshold)
+    if secondary:
+        mask |= secondary_mask(values, mask, by)
+    df.loc[mask] = np.nan
+    return df
@@ -0,0 +1,86 @@
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+## Wall time, CPU time, peak memory, rows, the bytes read from the file and
+## the in-memory size of the blocks read for each phase of each stage, kept
+## in a plain dict keyed on (stage, phase) so that reports from separate
+## processes can be merged. The peak is the most resident memory the process
+## had during the phase: Linux's high-water mark is reset as the phase starts
+## and read as it ends. It is the most over all the times the phase ran
+
+report_columns = [
+    "wall_seconds",
+    "cpu_seconds",
+    "peak_rss_bytes",
+    "rows",
+    "bytes_read",
+    "frame_bytes",
+]
+max_columns = ["peak_rss_bytes"]
+
+
+def reset_peak_rss():
+    # Without permission to reset it, the peak is the process's so far
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+@contextmanager
+def measure(report, stage, phase):
+    # The block can set "rows", "bytes_read" and "frame_bytes" on the dict it
+    # is given
+    sizes = {"rows": 0, "bytes_read": 0, "frame_bytes": 0}
+    reset_peak_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    yield sizes
+    record = report.setdefault((stage, phase), dict.fromkeys(report_columns, 0))
+    record["wall_seconds"] += time.perf_counter() - wall
+    record["cpu_seconds"] += time.process_time() - cpu
+    record["peak_rss_bytes"] = max(record["peak_rss_bytes"], peak_rss())
+    for column in ["rows", "bytes_read", "frame_bytes"]:
+        record[column] += sizes[column]
+
+
+def measured_blocks(blocks, report, stage):
+    # Yields the blocks, timing the read of each one as the load phase
+    blocks = iter(blocks)
+    while True:
+        with measure(report, stage, "load") as sizes:
+            block = next(blocks, None)
+            if block is not None:
+                sizes["rows"] = len(block)
+                # Set by the readers in cohort.py
+                sizes["bytes_read"] = block.attrs.get("bytes_read", 0)
+                sizes["frame_bytes"] = int(block.memory_usage(index=False).sum())
+        if block is None:
+            return
+        yield block
+
+
+def merge_reports(report, other):
+    for key, record in other.items():
+        total = report.setdefault(key, dict.fromkeys(report_columns, 0))
+        for column in report_columns:
+            if column in max_columns:
+                total[column] = max(total[column], record[column])
+            else:
+                total[column] += record[column]
+    return report
+
+
+def report_table(report):
+    table = pd.DataFrame.from_dict(report, orient="index", columns=report_columns)
+    table.index = pd.MultiIndex.from_tuples(table.index, names=["stage", "phase"])
+    return table.round({"wall_seconds": 3, "cpu_seconds": 3})
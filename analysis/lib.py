@@ -1,8 +1,11 @@
+import operator
+from datetime import datetime
+from functools import reduce
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime
-from IPython.display import display
+from codelists import codelist_table
+from disclosure import small_numbers
+from released_outputs import load_released
 
 
 # Counts over time graph
@@ -11,26 +14,30 @@ def line_format(label):
 
 
 def generic_graph_settings(ax, title):
+    import matplotlib.pyplot as plt
+
     xlim = ax.get_xlim()
-    ax.grid(b=False)
+    ax.grid(False)
     ax.set_title(title, loc="left")
     ax.set_xlim(xlim)
     ax.set_ylim(ymin=0)
     plt.tight_layout()
 
 
-def code_use_per_week_graph():
-    week_df = pd.read_csv(
-        "../released_outputs/output/code_use_per_week_long_covid.csv",
-        index_col="first_long_covid_date",
-        parse_dates=["first_long_covid_date"],
-    )
+def save_graph(paths, show):
+    import matplotlib.pyplot as plt
+
+    for path in paths:
+        plt.savefig(path)
+    if show:
+        plt.show()
+    plt.close()
+
+
+def code_use_per_week_graph(paths=("../output/code_use_per_week.svg",), show=True):
+    week_df = load_released("output", "code_use_per_week_long_covid")
     week_df = week_df.rename(columns={"long_covid": "TPP"})
-    week_emis = pd.read_csv(
-        "../released_outputs/emis/code_use_per_week_long_covid.csv",
-        index_col="first_long_covid_date",
-        parse_dates=["first_long_covid_date"],
-    )
+    week_emis = load_released("emis", "code_use_per_week_long_covid")
     week_emis = week_emis.rename(columns={"long_covid": "EMIS"})
     week_total = pd.concat([week_df, week_emis], axis=1)
 
@@ -44,21 +51,17 @@ def code_use_per_week_graph():
     ax.xaxis.label.set_visible(False)
     ax.set_ylabel("Count")
     generic_graph_settings(ax, title)
-    plt.savefig("../output/code_use_per_week.svg")
-    plt.show()
-    plt.close()
+    save_graph(paths, show)
 
 
-def practice_distribution_graph():
+def practice_distribution_graph(
+    paths=("../output/practice_distribution.svg",), show=True
+):
     ## Practice
-    practice_df = pd.read_csv(
-        "../released_outputs/output/practice_distribution.csv", index_col="long_covid"
-    )
+    practice_df = load_released("output", "practice_distribution")
     practice_df = practice_df.rename(columns={"long_covid.1": "TPP"})
     practice_df = (practice_df / practice_df.sum()) * 100
-    practice_emis = pd.read_csv(
-        "../released_outputs/emis/practice_distribution.csv", index_col="long_covid"
-    )
+    practice_emis = load_released("emis", "practice_distribution")
     practice_emis = practice_emis.rename(columns={"long_covid.1": "EMIS"})
     practice_emis = (practice_emis / practice_emis.sum()) * 100
     practice_total = pd.concat([practice_df, practice_emis], axis=1)
@@ -68,37 +71,36 @@ def practice_distribution_graph():
     ax.set_xticklabels(["0", "1", "2", "3", "4", "5", "6-10", "11+"])
     ax.set_ylabel("Percentage of practices")
     generic_graph_settings(ax, title)
-    plt.savefig("../output/practice_distribution.svg")
-    plt.show()
-    plt.close()
+    save_graph(paths, show)
     # print(practice_total)
 
 
 def counts_table_read(folder):
-    df = pd.read_csv(
-        f"../released_outputs/{folder}/counts_table.csv",
-        index_col=["Attribute", "Category"],
-    )
-    return df
-
-
-def add_cols(df):
-    return df["No long COVID"] + df["Long COVID"]
-
-
-def get_percentages(df, col_name):
-    percent = df.groupby(level=0).apply(lambda x: ((x / x.sum()) * 100).round(1))
-    return pd.concat([df, percent], keys=[col_name, "%"], axis=1)
+    return load_released(folder, "counts_table")
 
 
-def rename_index_categories(df, attribute, replacement_dict):
-    index = df.index.values
-    for old, new in replacement_dict.items():
-        for i, item in enumerate(index):
-            if item == (attribute, old):
-                index[i] = (attribute, new)
-    df.index = pd.MultiIndex.from_tuples(index)
-    return df
+def rename_index_categories(df, replacements):
+    # Relabel categories of each attribute, given {attribute: {old: new}}, in
+    # one lookup over the (attribute, category) pairs. The same label can mean
+    # different things for different attributes, such as "1" for ethnicity
+    # and imd, so the levels can't just be renamed. The attribute and category
+    # are the last two levels, so tables stacked by source work too. Returns a
+    # new frame
+    pairs = pd.Series(
+        {
+            (attribute, old): new
+            for attribute, categories in replacements.items()
+            for old, new in categories.items()
+        },
+        dtype=object,
+    )
+    if pairs.empty:
+        return df
+    levels = [df.index.get_level_values(i) for i in range(df.index.nlevels)]
+    new = pairs.reindex(pd.MultiIndex.from_arrays(levels[-2:])).to_numpy()
+    categories = levels[-1].to_numpy(dtype=object)
+    levels[-1] = np.where(pd.isna(new), categories, new)
+    return df.set_axis(pd.MultiIndex.from_arrays(levels, names=df.index.names))
 
 
 def tpp_emis_table_format(folder, renaming):
@@ -113,83 +115,154 @@ def tpp_emis_table_format(folder, renaming):
     }
     imd_categories = {"1": "Most deprived 1", "5": "Least deprived 5"}
     region_categories = {"East": "East of England"}
-    df = rename_index_categories(df, "ethnicity", high_level_ethnicities)
-    df = rename_index_categories(df, "imd", imd_categories)
-    df = rename_index_categories(df, "region", region_categories)
-    return df
-
-
-def get_table_1(table_list):
-    all_patients = [add_cols(df) for df in table_list]
-    table_1 = [get_percentages(df, "Patient count") for df in all_patients]
-    table_1[0]["sort_col"] = range(0, len(table_1[0]))
-    table_1 = pd.concat(table_1, keys=["TPP", "EMIS", "Totals"], axis=1, join="inner")
-    table_1 = table_1.sort_values(by=[("TPP", "sort_col")])
-    table_1 = table_1.drop(columns=("TPP", "sort_col"))
-    # .swaplevel(0,1,axis=1).sort_index(level=0, axis=1)
-    table_1.loc[:, (slice(None), "Patient count")] = table_1.loc[
-        :, (slice(None), "Patient count")
-    ].astype(int)
-    total = table_1.loc["sex"].sum(numeric_only=True)
-    return total, table_1
-
-
-def get_table_2(table_list):
-    all_patients = [add_cols(df) for df in table_list]
-    table_2 = [df.drop(columns="No long COVID") for df in table_list]
-    table_2[2] = get_percentages(table_2[2], "Long COVID")
-    table_2[2].columns = table_2[2].columns.droplevel(1)
-    table_2[2]["Rate per 100,000"] = (
-        (table_2[2]["Long COVID"] / all_patients[2]) * 100000
-    ).round(1)
-    table_2[0]["sort_col"] = range(0, len(table_2[0]))
-    table_2 = pd.concat(table_2, keys=["TPP", "EMIS", "Totals"], axis=1, join="inner")
-    table_2 = table_2.sort_values(by=[("TPP", "sort_col")])
-    table_2 = table_2.drop(columns=("TPP", "sort_col"))
-    # .swaplevel(0,1,axis=1).sort_index(level=0, axis=1)
-    table_2.loc[:, (slice(None), "Long COVID")] = table_2.loc[
-        :, (slice(None), "Long COVID")
-    ].astype(int)
-    total = table_2.loc["sex"].sum(numeric_only=True)
-    return total, table_2  # .style.format('{:,}')
-
-
-def read_codes_table(folder, file, sep=","):
-    df = pd.read_csv(
-        f"../released_outputs/{folder}/{file}.csv", sep=sep, index_col="code"
+    return rename_index_categories(
+        df,
+        {
+            "ethnicity": high_level_ethnicities,
+            "imd": imd_categories,
+            "region": region_categories,
+        },
     )
-    return df
 
 
-def smoosh_codes_tables():
-    tpp = read_codes_table("output", 'all_long_covid_codes',"\t")
-    emis = read_codes_table("emis", 'all_long_covid_codes_redacted')
-    emis["term"].update(tpp["term"])
-    terms = emis["term"].reset_index()
-    terms['code'] = terms['code'].apply(str)
-    tpp = tpp.merge(terms, on='term').set_index('code')
-    tpp = tpp[["Total records"]].apply(lambda x: pd.to_numeric(x, errors='coerce'))
-    emis = emis.merge(terms, on='term').set_index('code')
-    emis = emis[["Total records"]].apply(lambda x: pd.to_numeric(x, errors='coerce'))
-    total = tpp.add(emis, fill_value=0)
-    table_list = [tpp, emis, total]
+## Tables 1 and 2, from any number of sources
+count_columns = ["No long COVID", "Long COVID"]
+
+
+def add_totals(sources, name="Totals"):
+    # Another source, with the counts of all the others added up
+    totals = reduce(operator.add, (df[count_columns] for df in sources.values()))
+    return {**sources, name: totals}
+
+
+def group_percentages(values):
+    # Share of each category within its attribute
+    return (values / values.groupby(level=0).transform("sum") * 100).round(1)
+
+
+def source_columns(df):
+    # A source's columns in each table. Rates and percentages that were
+    # released with its counts are kept, the rest are worked out from them
+    all_patients = df["No long COVID"] + df["Long COVID"]
+    rates = df.get("Rate per 100,000")
+    if rates is None:
+        rates = (df["Long COVID"] / all_patients * 100000).round(1)
+    percentages = df.get("%")
+    if percentages is None:
+        percentages = group_percentages(df["Long COVID"])
+    table_1 = pd.DataFrame(
+        {"Patient count": all_patients, "%": group_percentages(all_patients)}
+    )
+    table_2 = pd.DataFrame(
+        {"Long COVID": df["Long COVID"], "Rate per 100,000": rates, "%": percentages}
+    )
+    return table_1, table_2
+
+
+def report_tables(sources):
+    # Both tables and their totals over the sex rows, from {name: counts
+    # table}. Rows are those that every source has, in the order of the first
+    names = list(sources)
+    indexes = [df.index for df in sources.values()]
+    rows = reduce(lambda rows, index: rows[rows.isin(index)], indexes)
+    columns = [source_columns(df) for df in sources.values()]
+
     tables = []
-    for table in table_list:
-        table = table.drop(table.tail(3).index)
-        table["%"] = (table["Total records"] / table["Total records"].sum()) * 100
-        tables.append(table)
-    terms = terms.set_index('code')
-    combined = pd.concat(
-        [terms] + tables,
-        keys=["", "TPP", "EMIS", "Total"],
+    for i, count in enumerate(["Patient count", "Long COVID"]):
+        table = pd.concat(
+            [source[i].reindex(rows) for source in columns], keys=names, axis=1
+        )
+        table = table.astype({(name, count): "int64" for name in names})
+        tables.append((table.loc["sex"].sum(numeric_only=True), table))
+    return tables
+
+
+## Codes table
+# Codes are reported for the long COVID codelists; the post-viral syndrome
+# codes that are counted with them are left out
+codes_table_codelists = [
+    "opensafely-nice-managing-the-long-term-effects-of-covid-19",
+    "opensafely-referral-and-signposting-for-long-covid",
+    "opensafely-assessment-instruments-and-outcome-measures-for-long-covid",
+]
+redacted = "[REDACTED]"
+
+
+def read_codelist_terms(codelists):
+    # From the compiled codelist index, whose codes are already stripped
+    terms = codelist_table(codelists)["term"]
+    terms.index = terms.index.astype("int64")
+    return terms.loc[~terms.index.duplicated()]
+
+
+def significant_figures(codes, digits=15):
+    # Codes as a spreadsheet would have saved them, rounded to `digits`
+    # significant figures
+    codes = np.asarray(codes, dtype="int64")
+    scale = 10 ** np.maximum(np.char.str_len(codes.astype(str)) - digits, 0)
+    return (codes + scale // 2) // scale * scale
+
+
+def normalise_codes(codes, reference):
+    # Int64 SNOMED codes, matched to the reference codes. Codes that have been
+    # through a spreadsheet lose their last digits, so they are matched on
+    # their first 15 significant figures, where that is unambiguous
+    codes = pd.Index(codes).astype(str).str.strip().astype("int64")
+    keys = pd.Series(reference, index=significant_figures(reference))
+    keys = keys.loc[~keys.index.duplicated(keep=False)]
+    positions = keys.index.get_indexer(significant_figures(codes))
+    codes = np.where(positions >= 0, keys.to_numpy()[positions], codes)
+    return pd.Index(codes, dtype="int64", name="code")
+
+
+def combine_codes_tables(sources, terms, total="Total", threshold=5):
+    # Counts from {name: codes table} for the codes in `terms`, and their
+    # total. A count that a source released blank or redacted stays redacted,
+    # and so does a total that is small or that would leave any of them out.
+    # Returns the sum of each column, and the table
+    listed = pd.concat(
+        {
+            name: df["Total records"].set_axis(normalise_codes(df.index, terms.index))
+            for name, df in sources.items()
+        },
+        names=["source", "code"],
+    )
+    codes = terms.index[terms.index.isin(listed.index.get_level_values("code"))]
+    # Every count is converted to a number in one go
+    counts = pd.to_numeric(listed, errors="coerce").unstack("source")
+    counts = counts.reindex(index=codes, columns=list(sources))
+    hidden = pd.Series(True, index=listed.index).unstack("source", fill_value=False)
+    hidden = hidden.reindex(index=codes, columns=list(sources), fill_value=False)
+    hidden &= counts.isna()
+
+    small = small_numbers(counts, threshold)
+    hidden |= small
+    counts = counts.mask(small)
+    counts[total] = counts.sum(axis=1, min_count=1)
+    small = small_numbers(counts[total], threshold)
+    # A total that leaves out a hidden count is hidden too, and is left out
+    # of the column's sum, so that it can't be worked out from the others
+    hidden[total] = hidden.any(axis=1) | small
+    counts[total] = counts[total].mask(hidden[total])
+
+    percentages = counts / counts.sum() * 100
+    table = pd.concat(
+        {
+            name: pd.DataFrame({"Total records": counts[name], "%": percentages[name]})
+            for name in counts
+        },
         axis=1,
-        join="outer",
     )
-    # REDACT
-    combined = combined.head(combined.shape[0]-3)
-    total = combined.sum(numeric_only=True)
-    combined.loc['1325151000000100'] = combined.loc['1325151000000100'].replace(np.nan,'[REDACTED]')
-    combined.loc['1325091000000109']['EMIS'] = '[REDACTED]'
-    combined.loc['1325121000000105']['EMIS'] = '[REDACTED]'
-    combined.loc['1325121000000105']['Total'] = '[REDACTED]'
-    return total, combined  # .set_index(pd.Index(combined["term"]))
\ No newline at end of file
+    sums = table.sum()
+    hidden = pd.concat({name: hidden[[name, name]] for name in hidden}, axis=1)
+    table = table.astype(object).mask(hidden.to_numpy(), redacted)
+    table.insert(0, ("", "term"), terms.loc[codes])
+    return sums, table
+
+
+def smoosh_codes_tables():
+    sources = {
+        "TPP": load_released("output", "codes_table"),
+        "EMIS": load_released("emis", "codes_table"),
+    }
+    return combine_codes_tables(sources, read_codelist_terms(codes_table_codelists))
@@ -0,0 +1,90 @@
+import hashlib
+import json
+
+## Static description of the cohort that study_definition_cohort writes: the
+## stratifiers, the dtype of every column and the expectations for its dummy
+## data. The analysis actions read it from cohort_manifest.json, rather than
+## importing cohortextractor and the codelists to work it out. Regenerate it
+## whenever the study changes with:
+##     python analysis/manifest.py
+
+manifest_path = "analysis/cohort_manifest.json"
+sources = [
+    "analysis/study_definition_cohort.py",
+    "analysis/common_variables.py",
+    "analysis/codelists.py",
+    "codelists/codelists.json",
+]
+covid_dates = ["sgss_positive", "primary_care_covid", "hospital_covid"]
+
+
+def source_key():
+    key = hashlib.sha1()
+    for path in sources:
+        with open(path, "rb") as f:
+            key.update(hashlib.sha1(f.read()).digest())
+    return key.hexdigest()
+
+
+def variable_dtype(variable):
+    # Compact dtype for a study definition variable, from what it returns
+    function, kwargs = variable
+    returning = kwargs.get("returning")
+    if returning == "number_of_matches_in_period":
+        return "uint16"
+    if returning in ("date", "date_admitted"):
+        return "date"
+    if returning == "pseudo_id":
+        return "int32"
+    if returning == "binary_flag":
+        return "bool"
+    return "category"
+
+
+def variable_dtypes(variables):
+    dtypes = {}
+    for name, variable in variables.items():
+        dtypes[name] = variable_dtype(variable)
+        if variable[1].get("include_date_of_match"):
+            dtypes[f"{name}_date"] = "date"
+    return dtypes
+
+
+def build_manifest():
+    from common_variables import demographic_variables
+    from study_definition_cohort import (
+        cohort_variables,
+        default_expectations,
+        index_date,
+    )
+
+    return {
+        "source_key": source_key(),
+        "stratifiers": list(demographic_variables.keys()),
+        "dtypes": variable_dtypes(cohort_variables),
+        # What the dummy data for each variable looks like, for generating
+        # synthetic cohorts
+        "index_date": index_date,
+        "default_expectations": default_expectations,
+        "expectations": {
+            name: kwargs.get("return_expectations", {})
+            for name, (function, kwargs) in cohort_variables.items()
+        },
+    }
+
+
+def read_manifest():
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest["source_key"] != source_key():
+        raise RuntimeError(
+            f"{manifest_path} is out of date; regenerate it with "
+            "python analysis/manifest.py"
+        )
+    return manifest
+
+
+if __name__ == "__main__":
+    with open(manifest_path, "w") as f:
+        json.dump(build_manifest(), f, indent=2)
+        f.write("\n")
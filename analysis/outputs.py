@@ -0,0 +1,62 @@
+import io
+import os
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype, is_numeric_dtype
+
+## Outputs of a run, held in memory as the stages write them and written out
+## once each when the run finishes, through a temporary file renamed into
+## place. Nothing is left partly written, and every file is opened just once,
+## which matters on networked workspace storage. Tables can be rendered with
+## pyarrow's CSV writer instead of pandas, which is much faster for large ones
+## but writes strings quoted and whole floats without a decimal point
+
+pending = {}
+csv_engines = ["pandas", "pyarrow"]
+
+
+def render_csv(data, engine="pandas"):
+    if engine == "pyarrow":
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+
+        if isinstance(data, pd.Series):
+            data = data.to_frame()
+        data = data.reset_index()
+        # Arrow can't write intervals or mixed objects, so those are written
+        # as the text that pandas would write for them
+        for column in data.columns:
+            values = data[column]
+            if not (is_numeric_dtype(values) or is_datetime64_any_dtype(values)):
+                data[column] = values.astype(str).where(values.notna())
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        pa_csv.write_csv(table, sink)
+        return sink.getvalue().to_pybytes()
+    return data.to_csv().encode()
+
+
+def write_csv(data, path, engine="pandas"):
+    pending[path] = render_csv(data, engine)
+
+
+def write_text(texts, path, echo=True):
+    # Each text followed by a blank line, as practice_summ.txt always was
+    buffer = io.StringIO()
+    for text in texts:
+        buffer.write(f"{text}\n\n")
+        if echo:
+            print(text)
+            print("\n")
+    pending[path] = buffer.getvalue().encode()
+
+
+def flush():
+    for path, data in pending.items():
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    pending.clear()
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from aggregation import category_codes, category_codes_with_missing
+
+## Practice-level counts from a single np.bincount over integer-coded
+## practices, and distributions across practices built from those counts
+
+
+def practice_counts(df, outcome, by=None):
+    # Coded patients and list size of every practice, split by the `by`
+    # column when given, such as the practice's region. Both come from one
+    # bincount over keys that pair each practice with the outcome. Counts for
+    # separate blocks of the cohort can be added up
+    keys, practices = category_codes(df["practice_id"])
+    levels = [pd.Index(practices, name="practice_id")]
+    if by is not None:
+        codes, labels = category_codes_with_missing(df[by])
+        keys = keys * len(labels) + codes
+        levels.append(pd.Index(labels, name=by))
+    n_keys = np.prod([len(level) for level in levels])
+    observed = keys >= 0
+    outcomes = df[outcome].to_numpy(dtype=bool)[observed]
+    counts = np.bincount(keys[observed] * 2 + outcomes, minlength=n_keys * 2)
+    counts = counts.reshape(n_keys, 2)
+
+    if by is None:
+        index = levels[0]
+    else:
+        index = pd.MultiIndex.from_product(levels)
+    counts = pd.DataFrame(
+        {"coded": counts[:, 1], "list_size": counts.sum(axis=1)}, index=index
+    )
+    return counts.loc[counts["list_size"] > 0]
+
+
+def practice_totals(counts):
+    # Totals for each practice, over any breakdown
+    return counts.groupby(level="practice_id").sum()
+
+
+def rates(counts, per=100000):
+    return counts["coded"] / counts["list_size"] * per
+
+
+def top_k(values, k):
+    # The k largest values, in no particular order, without sorting them all
+    values = np.asarray(values)
+    if k >= len(values):
+        return values
+    return values[np.argpartition(values, -k)[-k:]]
+
+
+def bin_index(values, edges):
+    # Right-closed bins like pd.cut; -1 for values outside them
+    bins = np.searchsorted(edges, np.asarray(values), side="left") - 1
+    return np.where((bins >= 0) & (bins < len(edges) - 1), bins, -1)
+
+
+def distribution(values, edges, name=None):
+    # Number of values in each bin, like groupby(pd.cut(values, edges)).count()
+    bins = bin_index(values, edges)
+    counts = np.bincount(bins[bins >= 0], minlength=len(edges) - 1)
+    intervals = pd.IntervalIndex.from_breaks(edges, name=name)
+    return pd.Series(counts, index=intervals, name=name)
+
+
+def grouped_distribution(values, groups, edges):
+    # As distribution, with a row for each group
+    bins = bin_index(values, edges)
+    group_codes, labels = category_codes_with_missing(groups)
+    n_bins = len(edges) - 1
+    binned = bins >= 0
+    counts = np.bincount(
+        (group_codes * n_bins + bins)[binned], minlength=len(labels) * n_bins
+    )
+    table = pd.DataFrame(
+        counts.reshape(len(labels), n_bins),
+        index=pd.Index(labels, name=groups.name),
+        columns=pd.IntervalIndex.from_breaks(edges, name="interval"),
+    )
+    # The row for missing groups is only kept when there are any
+    return table.loc[table.index.notna() | (table.sum(axis=1) > 0)]
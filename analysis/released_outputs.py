@@ -0,0 +1,67 @@
+import os
+from collections import namedtuple
+import pandas as pd
+
+## The released outputs that the report reads, each with how to parse it.
+## Parsed tables are kept for as long as their file's modification time and
+## size stay the same, so re-running a cell or drawing another figure from
+## the same file doesn't parse it again. Callers get a copy, which they are
+## free to change
+
+released_dir = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "released_outputs"
+)
+Released = namedtuple("Released", ["file", "options"])
+counts_table = Released(
+    "counts_table.csv",
+    dict(
+        index_col=["Attribute", "Category"],
+        dtype={"Attribute": str, "Category": str},
+    ),
+)
+code_use_per_week = {
+    variable: Released(
+        f"code_use_per_week_{variable}.csv",
+        dict(
+            index_col=f"first_{variable}_date", parse_dates=[f"first_{variable}_date"]
+        ),
+    )
+    for variable in ["long_covid", "post_viral_fatigue"]
+}
+practice_distribution = Released(
+    "practice_distribution.csv", dict(index_col="long_covid")
+)
+# Codes are read as text, as some have been through a spreadsheet and counts
+# may be "[REDACTED]"
+codes_options = dict(index_col="code", dtype=str)
+
+# Each source's files, by the name the report loads them with. "output" is
+# TPP, whose codes table was released tab-separated
+released_files = {
+    source: {
+        "counts_table": counts_table,
+        "code_use_per_week_long_covid": code_use_per_week["long_covid"],
+        "code_use_per_week_post_viral_fatigue": code_use_per_week["post_viral_fatigue"],
+        "practice_distribution": practice_distribution,
+        "codes_table": codes_table,
+    }
+    for source, codes_table in [
+        ("output", Released("all_long_covid_codes.csv", dict(codes_options, sep="\t"))),
+        ("emis", Released("all_long_covid_codes_redacted.csv", codes_options)),
+    ]
+}
+loaded = {}
+
+
+def released_path(source, name):
+    return os.path.join(released_dir, source, released_files[source][name].file)
+
+
+def load_released(source, name):
+    path = released_path(source, name)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    if loaded.get(path, (None,))[0] != version:
+        options = released_files[source][name].options
+        loaded[path] = (version, pd.read_csv(path, **options))
+    return loaded[path][1].copy()
@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import html
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from released_outputs import released_path
+from stage_cache import file_digest, write_atomic
+
+## The long COVID coding report, rendered without a Jupyter kernel. Figures
+## are drawn with the Agg backend in a pool of processes while the tables are
+## built, then everything is assembled into one HTML file. A figure is only
+## drawn again when lib.py or the released outputs it reads have changed.
+## Run from the top of the repository, like the other actions:
+##     python analysis/render_report.py
+
+report_path = "released_outputs/long_covid_coding_report.html"
+figures_dir = "output/report"
+# Each figure, with the released outputs it is drawn from
+figures = {
+    "code_use_per_week": (
+        "code_use_per_week_graph",
+        [
+            released_path("output", "code_use_per_week_long_covid"),
+            released_path("emis", "code_use_per_week_long_covid"),
+        ],
+    ),
+    "practice_distribution": (
+        "practice_distribution_graph",
+        [
+            released_path("output", "practice_distribution"),
+            released_path("emis", "practice_distribution"),
+        ],
+    ),
+}
+figure_formats = ["svg", "png"]
+paper = "https://doi.org/10.3399/BJGP.2021.0301"
+repository = "https://github.com/opensafely/long-covid"
+
+
+## Figures
+def figure_paths(name, out_dir):
+    return [os.path.join(out_dir, f"{name}.{ext}") for ext in figure_formats]
+
+
+def figure_key(name, out_dir):
+    key = hashlib.sha1(repr((name, figures[name][0], figure_formats)).encode())
+    for path in ["analysis/lib.py", "analysis/released_outputs.py"] + figures[name][1]:
+        key.update(file_digest(path, out_dir).encode())
+    return key.hexdigest()
+
+
+def render_figure(name, out_dir):
+    # Run in a process of its own, so the backend can be chosen before pyplot
+    # is first imported
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import lib
+
+    getattr(lib, figures[name][0])(figure_paths(name, out_dir), show=False)
+    return name
+
+
+def stale_figures(out_dir, state):
+    return [
+        name
+        for name in figures
+        if state.get(name) != figure_key(name, out_dir)
+        or not all(os.path.isfile(p) for p in figure_paths(name, out_dir))
+    ]
+
+
+## Tables and text
+def number(value):
+    return f"{value:,.0f}"
+
+
+def table_html(df):
+    return df.to_html(float_format="{:,.1f}".format, na_rep="", border=0)
+
+
+def series_html(series):
+    text = series.to_string(float_format="{:,.1f}".format)
+    return f"<pre>{html.escape(text)}</pre>"
+
+
+def report_sections():
+    import lib
+
+    tpp = lib.tpp_emis_table_format("output", {"0": "Missing"})
+    emis = lib.tpp_emis_table_format(
+        "emis", {"RGN11NM": "region", "0": "Missing", "6": "Missing"}
+    )
+    (total_1, table_1), (total_2, table_2) = lib.report_tables(
+        lib.add_totals({"TPP": tpp, "EMIS": emis})
+    )
+    codes_total, codes = lib.smoosh_codes_tables()
+    codes_total = codes_total[(slice(None), "Total records")]
+
+    return {
+        "counts": [
+            "<h3>Counts and rates of long COVID coding stratified by demographic "
+            "variable</h3>",
+            f'<p>This is equivalent to Table 2 from <a href="{paper}">the '
+            "paper</a></p>",
+            f"<p>There were {number(total_2[('Totals', 'Long COVID')])} people who "
+            "have been given a diagnostic code for long COVID to date. Counts for "
+            "each software system are:</p>",
+            series_html(total_2.loc[(slice(None), "Long COVID")]),
+            "<p>The overall rate of long COVID coding in the population was "
+            f"{round(total_2[('Totals', 'Rate per 100,000')] / 2, 1)} per 100,000 "
+            "people. Rates for each software system are:</p>",
+            series_html(total_2.loc[(slice(None), "Rate per 100,000")] / 2),
+            table_html(table_2),
+        ],
+        "code_use_per_week": [
+            "<h3>Use of long COVID codes over time</h3>",
+            "<p>Stratified by the electronic health record provider of the "
+            "practice (TPP/SystmOne or EMIS). Reporting lag may affect recent "
+            "dates.</p>",
+        ],
+        "practice_distribution": [
+            "<h3>Volume of code use in individual practices</h3>",
+            "<p>Stratified by the electronic health record provider of the "
+            "practice (TPP/SystmOne or EMIS).</p>",
+        ],
+        "codes": [
+            "<h3>Total use of each individual long COVID related code</h3>",
+            "<p>This is distinct from the above table in that it counts all coded "
+            "events, including where patients have been coded more than once.</p>",
+            f"<p>There were {number(codes_total['Total'])} long COVID codes used in "
+            "total. Counts for each software system were:</p>",
+            series_html(codes_total),
+            table_html(codes),
+        ],
+        "cohort": [
+            "<h3>Characteristics of the cohort</h3>",
+            f'<p>This is equivalent to Table 1 in <a href="{paper}">the '
+            "paper</a></p>",
+            f"<p>There were {number(total_1[('Totals', 'Patient count')])} people "
+            "in the cohort in total. In practices that use TPP software, there "
+            f"were {number(total_1[('TPP', 'Patient count')])}, while in practices "
+            "that use EMIS software, there were "
+            f"{number(total_1[('EMIS', 'Patient count')])} people.</p>",
+            table_html(table_1),
+        ],
+    }
+
+
+## Assembly
+def figure_html(name, out_dir):
+    # Inlined, so that the report is a single file
+    with open(os.path.join(out_dir, f"{name}.svg")) as f:
+        svg = f.read()
+    return svg[svg.index("<svg") :]
+
+
+def assemble(sections, out_dir):
+    body = [
+        "<h1>Long COVID coding in primary care.</h1>",
+        "<p>This OpenSAFELY report is a routine update of our peer-review paper "
+        "published in the <em>British Journal of General Practice</em> on the "
+        f'<a href="{paper}">Clinical coding of long COVID in English primary '
+        "care: a federated analysis of 58 million patient records in situ using "
+        "OpenSAFELY</a>.</p>",
+        "<p>It is a routine update of the analysis described in the paper. The "
+        "data requires careful interpretation and there are a number of caveats. "
+        "Please read the full detail about our methods and discussionis and the "
+        "full analytical methods on this routine report are "
+        f'<a href="{repository}">available on GitHub</a>.</p>',
+        "<p>OpenSAFELY is a new secure analytics platform for electronic patient "
+        "records built on behalf of NHS England to deliver urgent academic and "
+        "operational research during the pandemic. You can read more about "
+        f'<a href="{repository}">OpenSAFELY on our website</a>.</p>',
+        "<h2>Results</h2>",
+    ]
+    for name in ["counts", "code_use_per_week", "practice_distribution", "codes"]:
+        body += sections[name]
+        if name in figures:
+            body.append(figure_html(name, out_dir))
+    body += sections["cohort"]
+    return (
+        '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+        "<title>Long COVID coding in primary care</title>\n</head>\n<body>\n"
+        + "\n".join(body)
+        + "\n</body>\n</html>\n"
+    )
+
+
+def render(out_dir=figures_dir, output=report_path, jobs=None, force=False):
+    os.makedirs(out_dir, exist_ok=True)
+    state_path = os.path.join(out_dir, "render_state.json")
+    state = {}
+    if os.path.isfile(state_path) and not force:
+        with open(state_path) as f:
+            state = json.load(f)
+
+    stale = stale_figures(out_dir, state)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        drawn = pool.map(render_figure, stale, [out_dir] * len(stale))
+        sections = report_sections()
+        for name in drawn:
+            state[name] = figure_key(name, out_dir)
+            print(f"Drew {name}")
+
+    write_atomic(output, assemble(sections, out_dir).encode())
+    write_atomic(state_path, json.dumps(state, indent=2).encode())
+    return stale
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render the long COVID coding report as HTML, drawing only "
+        "the figures whose inputs have changed"
+    )
+    parser.add_argument("--output", default=report_path)
+    parser.add_argument(
+        "--figures-dir",
+        default=figures_dir,
+        help="Where the SVG and PNG figures are written",
+    )
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="Draw every figure again")
+    args = parser.parse_args()
+    render(args.figures_dir, args.output, args.jobs, args.force)
+
+
+if __name__ == "__main__":
+    main()
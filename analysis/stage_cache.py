@@ -0,0 +1,163 @@
+import ast
+import glob
+import hashlib
+import inspect
+import json
+import os
+from functools import partial
+import pandas as pd
+
+## Cache of the unredacted totals of each stage, addressed by a hash of
+## everything they depend on: the cohort and code events, the codelists, the
+## code that counts them and that code's parameters. Entries that haven't
+## been used for longest are evicted once the cache is over its size. This is
+## for local runs: an action's outputs aren't kept for its next run, so the
+## cache would start empty every time
+
+analysis_dir = os.path.dirname(os.path.abspath(__file__))
+# Data that the counting modules read, besides the codelists
+counting_data = [os.path.join(analysis_dir, "cohort_manifest.json")]
+constant_types = (str, int, float, list, tuple, dict)
+
+
+def file_digest(path, cache_dir):
+    # Hashing a whole cohort takes a while, so digests are remembered for as
+    # long as the file's size and modification time stay the same
+    memo_path = os.path.join(cache_dir, "file_digests.json")
+    memo = {}
+    if os.path.isfile(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+    stat = os.stat(path)
+    path = os.path.abspath(path)
+    if memo.get(path, [None])[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return memo[path][2]
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            digest.update(block)
+    memo[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    write_atomic(memo_path, json.dumps(memo).encode())
+    return memo[path][2]
+
+
+def function_digest(function):
+    # Source of the function, with the arguments bound to it, its defaults and
+    # the simple module constants it refers to
+    args = ()
+    if isinstance(function, partial):
+        args = (function.args, sorted(function.keywords.items()))
+        function = function.func
+    constants = {
+        name: function.__globals__[name]
+        for name in function.__code__.co_names
+        if isinstance(function.__globals__.get(name), constant_types)
+    }
+    return repr((inspect.getsource(function), args, function.__defaults__, constants))
+
+
+def local_module(name):
+    path = os.path.join(analysis_dir, f"{name.split('.')[0]}.py")
+    return path if os.path.isfile(path) else None
+
+
+def imported_modules(path):
+    # Each name imported anywhere in the file, with the module it comes from
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    modules = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module:
+            for alias in node.names:
+                modules[alias.asname or alias.name] = node.module
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                modules[alias.asname or alias.name.split(".")[0]] = alias.name
+    return modules
+
+
+def code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+    return names
+
+
+def module_sources(functions):
+    # The modules in analysis/ that the functions import names from, and the
+    # modules in analysis/ that those import in turn. The functions' own
+    # module is left out, as function_digest covers what they use of it
+    to_visit = []
+    for function in functions:
+        if isinstance(function, partial):
+            function = function.func
+        modules = imported_modules(inspect.getsourcefile(function))
+        to_visit += [
+            modules[name] for name in code_names(function.__code__) if name in modules
+        ]
+    sources = set()
+    while to_visit:
+        path = local_module(to_visit.pop())
+        if path is not None and path not in sources:
+            sources.add(path)
+            to_visit += imported_modules(path).values()
+    return sorted(sources)
+
+
+def stage_key(name, stage, inputs, cache_dir, shard=None, readers=(), combiners=()):
+    # `inputs` are the paths that the stage reads, besides the codelists,
+    # `readers` the functions that read them and `combiners` those that
+    # filter the blocks read and add up their counts
+    key = hashlib.sha1(repr((name, stage.columns, shard)).encode())
+    counts = [count for count in [stage.count, stage.count_events] if count]
+    for function in counts + list(combiners):
+        key.update(function_digest(function).encode())
+    codelists = sorted(glob.glob("codelists/*.csv")) + ["codelists/codelists.json"]
+    readers = list(readers)
+    sources = module_sources(counts + list(combiners) + readers)
+    sources += [inspect.getsourcefile(reader) for reader in readers]
+    sources = sorted(set(sources))
+    for path in inputs + codelists + counting_data + sources:
+        key.update(file_digest(path, cache_dir).encode())
+    return key.hexdigest()
+
+
+def entry_path(cache_dir, key):
+    return os.path.join(cache_dir, f"{key}.pickle")
+
+
+def read_entry(cache_dir, key):
+    path = entry_path(cache_dir, key)
+    if not os.path.isfile(path):
+        return None
+    # Touched on every use, so that the least recently used go first
+    os.utime(path)
+    return pd.read_pickle(path)
+
+
+def write_entry(cache_dir, key, totals):
+    tmp_path = f"{entry_path(cache_dir, key)}.{os.getpid()}.tmp"
+    pd.to_pickle(totals, tmp_path)
+    os.replace(tmp_path, entry_path(cache_dir, key))
+
+
+def evict(cache_dir, max_bytes):
+    # Least recently used first, until the entries fit in `max_bytes`
+    entries = sorted(
+        glob.glob(os.path.join(cache_dir, "*.pickle")), key=os.path.getmtime
+    )
+    size = sum(os.path.getsize(path) for path in entries)
+    for path in entries:
+        if size <= max_bytes:
+            break
+        size -= os.path.getsize(path)
+        os.remove(path)
+
+
+def write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
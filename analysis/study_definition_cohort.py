@@ -8,49 +8,25 @@ from cohortextractor import (
 )
 
 from codelists import *
-from common_variables import demographic_variables, clinical_variables
-
-pandemic_start = "2020-02-01"
-
-
-def make_variable(code):
-    return {
-        f"snomed_{code}": (
-            patients.with_these_clinical_events(
-                codelist([code], system="snomed"),
-                on_or_after=pandemic_start,
-                returning="number_of_matches_in_period",
-                include_date_of_match=True,
-                date_format="YYYY-MM-DD",
-                return_expectations={
-                    "incidence": 0.1,
-                    "int": {"distribution": "normal", "mean": 3, "stddev": 1},
-                },
-            )
-        )
-    }
-
-
-def loop_over_codes(code_list):
-    variables = {}
-    for code in code_list:
-        variables.update(make_variable(code))
-    return variables
+from common_variables import (
+    demographic_variables,
+    clinical_variables,
+    loop_over_codes,
+    pandemic_start,
+)
 
+default_expectations = {
+    "date": {"earliest": "index_date", "latest": "today"},
+    "rate": "uniform",
+    "incidence": 0.05,
+    "int": {"distribution": "normal", "mean": 25, "stddev": 5},
+    "float": {"distribution": "normal", "mean": 25, "stddev": 5},
+}
+index_date = "2020-11-01"
 
-study = StudyDefinition(
-    default_expectations={
-        "date": {"earliest": "index_date", "latest": "today"},
-        "rate": "uniform",
-        "incidence": 0.05,
-        "int": {"distribution": "normal", "mean": 25, "stddev": 5},
-        "float": {"distribution": "normal", "mean": 25, "stddev": 5},
-    },
-    index_date="2020-11-01",
-    population=patients.satisfying(
-        "registered AND (sex = 'M' OR sex = 'F')",
-        registered=patients.registered_as_of("index_date"),
-    ),
+# The cohort's columns, kept apart from the StudyDefinition so that
+# manifest.py can describe them
+cohort_variables = dict(
     # COVID infection
     sgss_positive=patients.with_test_result_in_sgss(
         pathogen="SARS-CoV-2",
@@ -129,3 +105,13 @@ study = StudyDefinition(
     **demographic_variables,
     # **clinical_variables,
 )
+
+study = StudyDefinition(
+    default_expectations=default_expectations,
+    index_date=index_date,
+    population=patients.satisfying(
+        "registered AND (sex = 'M' OR sex = 'F')",
+        registered=patients.registered_as_of("index_date"),
+    ),
+    **cohort_variables,
+)